@@ -7,7 +7,7 @@ if [ ! -d "$VENV_DIR" ]; then
   python3 -m venv $VENV_DIR
   source "${VENV_DIR}/bin/activate"
   pip install bleak
-  pip install paho-mqtt
+  pip install "paho-mqtt>=2.0"
 fi
 
 if [ -d "$VENV_DIR" ]; then
@@ -1,15 +1,28 @@
 import asyncio
+import collections
 import configparser
+import heapq
+import itertools
 import json
+import math
 import os
+import signal
+import struct
 import time
 
-from bleak import BleakScanner
-import paho.mqtt.publish as publish
+from bleak import BleakClient, BleakScanner
+from bleak.assigned_numbers import AdvertisementDataType
+import paho.mqtt.client as mqtt
 
-from enum import Enum
+from switchbot_capture import CaptureWriter, decode_advertisement_record, encode_advertisement, generate_synthetic, replay_capture, synthetic_devices
+from switchbot_decoder import MANUFACTURER_ID, UUID_BROADCAST, SwitchbotDeviceType, PlugMiniAdvertisement, advertisement_device_type, decode_advertisement
+from switchbot_energy import EnergyIntegrator
+from switchbot_gatt import SWITCHBOT_COMMANDS, CommandError, GattPool
+from switchbot_history import HISTORY_FIELDS, HISTORY_RESOLUTIONS, DeviceHistory, history_samples_json
+from switchbot_metrics import Counter, Gauge, Histogram, serve_metrics, snapshot_metrics
+from switchbot_persistence import PersistenceStore
 
-config_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.ini")
+config_path = os.environ.get("SWITCHBOT_CONFIG", os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.ini"))
 config = configparser.ConfigParser()
 config.optionxform = str
 config.read(config_path)
@@ -21,50 +34,120 @@ MQTT_PORT = int(config["mqtt"]["port"])
 MQTT_USERNAME = config["mqtt"]["username"]
 MQTT_PASSWORD = config["mqtt"]["password"]
 MQTT_TOPIC_PREFIX = config["mqtt"]["topic_prefix"]
+MQTT_CLIENT_ID = config["mqtt"].get("client_id", "")
+MQTT_KEEPALIVE = config["mqtt"].getint("keepalive", 60)
+MQTT_QOS = config["mqtt"].getint("qos", 0)
+MQTT_QUEUE_SIZE = config["mqtt"].getint("queue_size", 10000)
+MQTT_RECONNECT_MAX = float(config["mqtt"].get("reconnect_max", "60"))
+MQTT_STATUS_TOPIC = f"{MQTT_TOPIC_PREFIX}/status"
 
 HOMEASSISTANT_SEND_CONFIG = config['homeassistant'].getboolean("send_config")
+HOMEASSISTANT_STATUS_TOPIC = config['homeassistant'].get("status_topic", "homeassistant/status")
 
 PERSISTENCE_ENABLED = config["persistence"].getboolean("enabled")
 PERSISTENCE_SAVE_PERIOD = int(config["persistence"]["save_period"])
 PERSISTENCE_PATH = config["persistence"]["path"]
+PERSISTENCE_JOURNAL_LIMIT = config["persistence"].getint("journal_limit", 100)
 
-METER_DEVICES = { name.replace("_", " "):config['meter'][name] for name in config['meter'] }
-METER_ADDRESSES = [ METER_DEVICES[name] for name in METER_DEVICES ]
-
-IO_THERMOHYDRO_DEVICES = { name.replace("_", " "):config['io_thermohydro'][name] for name in config['io_thermohydro'] }
-IO_THERMOHYDRO_ADDRESSES = [ IO_THERMOHYDRO_DEVICES[name] for name in IO_THERMOHYDRO_DEVICES ]
-
-PLUG_MINI_DEVICES = { name.replace("_", " "):config['plug_mini'][name] for name in config['plug_mini'] }
-PLUG_MINI_ADDRESSES = [ PLUG_MINI_DEVICES[name] for name in PLUG_MINI_DEVICES ]
-
-ADDRESS_TO_NAME = { }
-ADDRESS_TO_TYPE = { }
-for device_type in [METER_DEVICES, IO_THERMOHYDRO_DEVICES, PLUG_MINI_DEVICES]:
-    for name, address in device_type.items():
-        ADDRESS_TO_NAME[address] = name
-        ADDRESS_TO_TYPE[address] = lambda : device_type
-
-UUID_REQUEST = "cba20002-224d-11e6-9fb8-0002a5d5c51b"
-UUID_RESPONSE = "cba20003-224d-11e6-9fb8-0002a5d5c51b"
-UUID_BROADCAST = "0000fd3d-0000-1000-8000-00805f9b34fb"
-
-class SwitchbotDeviceType(Enum):
-    BOT = 0x48              # Not supported
-    METER = 0x54
-    CURTAIN = 0x63          # Not supported
-    CONTACT_SENSOR = 0x64   # Not supported
-    HUMIDIFIER = 0x65       # Not supported
-    PLUG_MINI = 0x67
-    METER_PLUS = 0x69
-    SMART_LOCK = 0x6F       # Not supported
-    LED_STRIP = 0x72        # Not supported
-    MOTION_SENSOR = 0x73    # Not supported
-    COLOR_BULB = 0x75       # Not supported
-    IO_THERMOHYDRO = 0x77
-    CURTAIN_3 = 0x7B        # Not supported
-
-SwitchbotDeviceTypeValues = [item.value for item in SwitchbotDeviceType]
-SwitchbotDeviceTypeNames = [item.name for item in SwitchbotDeviceType]
+SCANNER_ADAPTERS = [ adapter.strip() for adapter in config["scanner"].get("adapters", "").split(",") if adapter.strip() != "" ] if config.has_section("scanner") else []
+SCANNER_ROLE = config["scanner"].get("role", "standalone") if config.has_section("scanner") else "standalone"
+SCANNER_NODE_NAME = config["scanner"].get("node_name", "node") if config.has_section("scanner") else "node"
+SCANNER_FORWARD_PERIOD = float(config["scanner"].get("forward_period", "0.5")) if config.has_section("scanner") else 0.5
+SCANNER_DEDUPE_WINDOW = float(config["scanner"].get("dedupe_window", "2")) if config.has_section("scanner") else 2.0
+SCANNER_MODE = config["scanner"].get("scanning_mode", "active") if config.has_section("scanner") else "active"
+SCANNER_DUTY_ON = float(config["scanner"].get("duty_on", "0")) if config.has_section("scanner") else 0.0
+SCANNER_DUTY_OFF = float(config["scanner"].get("duty_off", "0")) if config.has_section("scanner") else 0.0
+SCANNER_DUTY_CYCLE = SCANNER_DUTY_ON > 0 and SCANNER_DUTY_OFF > 0
+SCANNER_RAW_TOPIC = f"{MQTT_TOPIC_PREFIX}/raw"
+# Passive scanning on BlueZ only reports advertisements matching one of these patterns
+SCANNER_OR_PATTERNS = [
+    (0, AdvertisementDataType.SERVICE_DATA_UUID16, bytes.fromhex("3dfd")),
+    (0, AdvertisementDataType.MANUFACTURER_SPECIFIC_DATA, MANUFACTURER_ID.to_bytes(2, "little")),
+]
+
+AVAILABILITY_MULTIPLIER = float(config["availability"].get("multiplier", "10")) if config.has_section("availability") else 10.0
+AVAILABILITY_MIN_TIMEOUT = float(config["availability"].get("min_timeout", "30")) if config.has_section("availability") else 30.0
+AVAILABILITY_MAX_TIMEOUT = float(config["availability"].get("max_timeout", "300")) if config.has_section("availability") else 300.0
+AVAILABILITY_SMOOTHING = 0.1
+
+PIPELINE_QUEUE_SIZE = config["pipeline"].getint("queue_size", 4096) if config.has_section("pipeline") else 4096
+PIPELINE_BATCH_SIZE = config["pipeline"].getint("batch_size", 256) if config.has_section("pipeline") else 256
+PIPELINE_OVERFLOW = config["pipeline"].get("overflow", "drop_oldest") if config.has_section("pipeline") else "drop_oldest"
+
+METRICS_ENABLED = config["metrics"].getboolean("enabled", False) if config.has_section("metrics") else False
+METRICS_HOST = config["metrics"].get("host", "127.0.0.1") if config.has_section("metrics") else "127.0.0.1"
+METRICS_PORT = config["metrics"].getint("port", 9105) if config.has_section("metrics") else 9105
+METRICS_MQTT_PERIOD = float(config["metrics"].get("mqtt_period", "0")) if config.has_section("metrics") else 0.0
+
+ENERGY_MAX_GAP = float(config["energy"].get("max_gap", "60")) if config.has_section("energy") else 60.0
+
+HISTORY_ENABLED = config["history"].getboolean("enabled", False) if config.has_section("history") else False
+HISTORY_PATH = config["history"].get("path", "") if config.has_section("history") else ""
+HISTORY_CAPACITIES = {
+    "raw": config["history"].getint("raw_samples", 3600) if config.has_section("history") else 3600,
+    "1m": config["history"].getint("minute_samples", 1440) if config.has_section("history") else 1440,
+    "15m": config["history"].getint("quarter_hour_samples", 672) if config.has_section("history") else 672,
+}
+HISTORY_BACKFILL_LIMIT = config["history"].getint("backfill_limit", 1000) if config.has_section("history") else 1000
+
+COMMANDS_ENABLED = config["commands"].getboolean("enabled", False) if config.has_section("commands") else False
+COMMANDS_POOL_SIZE = config["commands"].getint("pool_size", 3) if config.has_section("commands") else 3
+COMMANDS_IDLE_TIMEOUT = float(config["commands"].get("idle_timeout", "30")) if config.has_section("commands") else 30.0
+COMMANDS_TIMEOUT = float(config["commands"].get("timeout", "10")) if config.has_section("commands") else 10.0
+
+CAPTURE_RECORD_PATH = config["capture"].get("record", "") if config.has_section("capture") else ""
+CAPTURE_REPLAY_PATH = config["capture"].get("replay", "") if config.has_section("capture") else ""
+CAPTURE_REPLAY_SPEED = float(config["capture"].get("replay_speed", "1")) if config.has_section("capture") else 1.0
+CAPTURE_SYNTHETIC_METERS = config["capture"].getint("synthetic_meters", 0) if config.has_section("capture") else 0
+CAPTURE_SYNTHETIC_PLUGS = config["capture"].getint("synthetic_plugs", 0) if config.has_section("capture") else 0
+
+UNKNOWN_AUTO_ENROLL = config["unknown_devices"].getboolean("auto_enroll", False) if config.has_section("unknown_devices") else False
+UNKNOWN_MIN_RSSI = config["unknown_devices"].getint("min_rssi", -80) if config.has_section("unknown_devices") else -80
+UNKNOWN_ENROLL_PATH = config["unknown_devices"].get("path", "") if config.has_section("unknown_devices") else ""
+UNKNOWN_REPORT_PERIOD = float(config["unknown_devices"].get("report_period", "0")) if config.has_section("unknown_devices") else 0.0
+UNKNOWN_ENABLED = UNKNOWN_AUTO_ENROLL or UNKNOWN_REPORT_PERIOD > 0
+UNKNOWN_HOLDOFF = UNKNOWN_REPORT_PERIOD if UNKNOWN_REPORT_PERIOD > 0 else 10.0
+if UNKNOWN_ENROLL_PATH == "":
+    UNKNOWN_ENROLL_PATH = os.path.join(os.path.dirname(config_path), "switchbot-enrolled.json")
+
+CONFIG_WATCH_PERIOD = float(config["reload"].get("watch_period", "5")) if config.has_section("reload") else 5.0
+
+SYNTHETIC_DEVICES = synthetic_devices(CAPTURE_SYNTHETIC_METERS, CAPTURE_SYNTHETIC_PLUGS)
+# Seconds of advertisement time per second of real time, above 1 when replaying faster than recorded
+CAPTURE_CLOCK_RATE = CAPTURE_REPLAY_SPEED if (CAPTURE_REPLAY_PATH != "" or len(SYNTHETIC_DEVICES) > 0) and CAPTURE_REPLAY_SPEED > 0 else 1.0
+
+# Devices admitted by auto enrollment, address -> { "section": ..., "name": ... }
+UNKNOWN_ENROLLED = PersistenceStore(UNKNOWN_ENROLL_PATH)
+if UNKNOWN_AUTO_ENROLL:
+    UNKNOWN_ENROLLED.load()
+
+METER_DEVICES = { }
+IO_THERMOHYDRO_DEVICES = { }
+PLUG_MINI_DEVICES = { }
+
+DEVICE_TABLES = (
+    ("meter", SwitchbotDeviceType.METER, METER_DEVICES),
+    ("io_thermohydro", SwitchbotDeviceType.IO_THERMOHYDRO, IO_THERMOHYDRO_DEVICES),
+    ("plug_mini", SwitchbotDeviceType.PLUG_MINI, PLUG_MINI_DEVICES),
+)
+
+
+def config_load_devices(parser):
+    """Replace the contents of the device tables with the devices in a parsed config."""
+    sections = [ { name.replace("_", " "):parser[section][name] for name in parser[section] } for section, _, _ in DEVICE_TABLES ]
+    for device_type, name, address in SYNTHETIC_DEVICES:
+        sections[2 if device_type == SwitchbotDeviceType.PLUG_MINI else 0][name] = address
+    configured = set(address for devices in sections for address in devices.values())
+    for address, enrolled in UNKNOWN_ENROLLED.data.items():
+        if address not in configured:
+            index = [ section for section, _, _ in DEVICE_TABLES ].index(enrolled["section"])
+            sections[index][enrolled["name"]] = address
+    for (section, device_type, devices), loaded in zip(DEVICE_TABLES, sections):
+        devices.clear()
+        devices.update(loaded)
+
+
+config_load_devices(config)
 
 SWITCHBOT_METADATA = {
     SwitchbotDeviceType.METER: {
@@ -109,17 +192,115 @@ SWITCHBOT_METADATA = {
     },
 }
 
+# A device's state is published when a field moves by at least its deadband
+# since the last publish (fields without a deadband publish on any change),
+# no more often than min_interval and at least every max_interval seconds.
+SWITCHBOT_PUBLISH_POLICY = {
+    SwitchbotDeviceType.METER: {
+        "min_interval": 0,
+        "max_interval": 300,
+        "deadband": { "rssi": 5, "battery": 1, "temperature": 0.1, "humidity": 1 },
+    },
+    SwitchbotDeviceType.METER_PLUS: {
+        "min_interval": 0,
+        "max_interval": 300,
+        "deadband": { "rssi": 5, "battery": 1, "temperature": 0.1, "humidity": 1 },
+    },
+    SwitchbotDeviceType.IO_THERMOHYDRO: {
+        "min_interval": 0,
+        "max_interval": 300,
+        "deadband": { "rssi": 5, "battery": 1, "temperature": 0.1, "humidity": 1 },
+    },
+    SwitchbotDeviceType.PLUG_MINI: {
+        "min_interval": 10,
+        "max_interval": 300,
+        "deadband": { "rssi": 5, "power": 0.001, "energy": 0.001, "energy_error": 0.001 },
+    },
+}
+
+
+def publish_policy_override(policies, options):
+    """Apply [publish] overrides, e.g. "meter_temperature = 0.2" or "plug_mini_min_interval = 30".
+
+    Meter Plus devices are configured in the meter section, so meter_ options
+    apply to them too unless a meter_plus_ option overrides the same setting.
+    """
+    for device_type, policy in policies.items():
+        prefixes = [f"{device_type.name.lower()}_"]
+        if device_type == SwitchbotDeviceType.METER_PLUS:
+            prefixes.insert(0, "meter_")
+        for prefix in prefixes:
+            for option in options:
+                if not option.startswith(prefix) or option[len(prefix):].startswith("plus_"):
+                    continue
+                field = option[len(prefix):]
+                if field in ("min_interval", "max_interval"):
+                    policy[field] = float(options[option])
+                else:
+                    policy["deadband"][field] = float(options[option])
+
+
+if config.has_section("publish"):
+    publish_policy_override(SWITCHBOT_PUBLISH_POLICY, config["publish"])
+
+# Immutable identity of a configured device with its precomputed topics, keyed by address
+DeviceRecord = collections.namedtuple("DeviceRecord", ["address", "device_type", "name", "safe_name", "key", "object_id", "state_topic", "history_topic", "command_topic", "result_topic", "discovery_topics"])
+
+SWITCHBOT_DEVICES = { }
+# object_id -> DeviceRecord, kept in step with SWITCHBOT_DEVICES by device_register/device_remove
+SWITCHBOT_OBJECT_IDS = { }
 SWITCHBOT_DATA = { }
-SWITCHBOT_PERSISTENCE = { }
+SWITCHBOT_PERSISTENCE = PersistenceStore(PERSISTENCE_PATH, PERSISTENCE_JOURNAL_LIMIT)
+SWITCHBOT_PUBLISHED = { }
+SWITCHBOT_ENERGY = { }
+SWITCHBOT_HISTORY = { }
 
+# Frames of (source time, timestamp, address, rssi, service data, manufacturer data). Source time
+# is time.monotonic() for live advertisements and the recorded timestamp for replayed ones.
+PIPELINE_QUEUE = collections.deque()
+PIPELINE_READY = None
+PIPELINE_DROPPED = 0
 
-def make_device_key(device_type, address):
-    return f"{device_type}-{address}"
+METRIC_ADVERTISEMENTS = Counter("switchbot_advertisements_total", "Advertisements received from configured devices", ("address",))
+METRIC_ADVERTISEMENT_SECONDS = Histogram("switchbot_advertisement_process_seconds", "Time to deduplicate, decode and apply an advertisement")
+METRIC_DROPPED = Gauge("switchbot_advertisements_dropped_total", "Advertisements dropped because the queue was full", lambda: PIPELINE_DROPPED, "counter")
+METRIC_QUEUE = Gauge("switchbot_advertisement_queue_length", "Advertisements waiting to be processed", lambda: len(PIPELINE_QUEUE))
+METRIC_PUBLISH_SECONDS = Histogram("switchbot_mqtt_publish_seconds", "Time to publish one cycle of device state")
+METRIC_MESSAGES = Counter("switchbot_mqtt_messages_total", "Messages handed to the MQTT client")
+METRIC_PENDING = Gauge("switchbot_mqtt_pending_messages", "Messages queued while the MQTT server is unreachable", lambda: len(MQTT_PENDING))
+METRIC_CONNECTS = Counter("switchbot_mqtt_connects_total", "Connections established to the MQTT server")
+METRIC_COMMANDS = Counter("switchbot_commands_total", "Commands sent to devices over GATT", ("status",))
+METRIC_COMMAND_SECONDS = Histogram("switchbot_command_seconds", "Time to connect to a device, send a command and receive the response")
+METRIC_PERSISTENCE_SECONDS = Histogram("switchbot_persistence_save_seconds", "Time to save persistence data")
+
+SCANNER_SEEN = { }
+UNKNOWN_SEEN = { }
+SCANNER_FORWARD_BUFFER = bytearray()
+SCANNER_RESUMED = 0.0
+# Remote node name -> source time of the last advertisement queued from it
+SCANNER_NODE_TIMES = { }
+
+# address -> { "last": source time last heard, "interval": smoothed seconds between advertisements,
+#              "deadline": monotonic time the device goes offline,
+#              "scheduled", "sequence": deadline and tie breaker of its live AVAILABILITY_HEAP entry }
+SWITCHBOT_AVAILABILITY = { }
+AVAILABILITY_HEAP = []
+AVAILABILITY_SEQUENCE = itertools.count()
+AVAILABILITY_WAKE = None
 
+HOMEASSISTANT_DISCOVERY = { }
 
-def split_device_key(device_key):
-    tokens = device_key.split("-")
-    return tokens[0], tokens[1]
+HISTORY_OFFLINE_SINCE = None
+HISTORY_BACKFILL_TASK = None
+
+COMMAND_TASKS = set()
+
+MQTT_CLIENT = None
+MQTT_PENDING = collections.deque(maxlen=MQTT_QUEUE_SIZE)
+
+
+def make_device_key(device_type, address):
+    return f"{device_type}-{address}"
 
 
 def get_safe_name(name):
@@ -130,171 +311,601 @@ def get_safe_device_key(device_key):
     return device_key.replace(":", "_")
 
 
-async def switchbot_scan_unknown():
-    def process_advertisement(device, data):
-        timestamp = time.time()
-        address = device.address
-        rssi = data.rssi
-        if UUID_BROADCAST not in data.service_data:
+def make_device_record(address, device_type, name):
+    object_id = f"{get_safe_name(device_type.name)}_{get_safe_name(name)}"
+    discovery_topics = tuple((field, f"homeassistant/sensor/{MQTT_TOPIC_PREFIX}_{object_id}/{field}/config") for field in SWITCHBOT_METADATA[device_type]["fields"])
+    return DeviceRecord(address, device_type, name, get_safe_name(name), make_device_key(device_type.name, address), object_id, f"{MQTT_TOPIC_PREFIX}/{object_id}/data", f"{MQTT_TOPIC_PREFIX}/{object_id}/history", f"{MQTT_TOPIC_PREFIX}/{object_id}/set", f"{MQTT_TOPIC_PREFIX}/{object_id}/result", discovery_topics)
+
+
+def device_registry_build():
+    """Build the address to DeviceRecord index from the configured devices."""
+    registry = { }
+    for section, device_type, devices in DEVICE_TABLES:
+        for name, address in devices.items():
+            registry[address] = make_device_record(address, device_type, name)
+    return registry
+
+
+def device_registry_resolve(address, device_type):
+    """Replace a device's record when it advertises a different type than configured, e.g. a Meter Plus in the meter section."""
+    record = device_register(make_device_record(address, device_type, SWITCHBOT_DEVICES[address].name))
+    SWITCHBOT_DATA.pop(address, None)
+    SWITCHBOT_PUBLISHED.pop(address, None)
+    SWITCHBOT_ENERGY.pop(address, None)
+    SWITCHBOT_AVAILABILITY.pop(address, None)
+    history_close(address)
+    return record
+
+
+def device_register(record):
+    """Add or replace a device's record in SWITCHBOT_DEVICES and the object_id index."""
+    previous = SWITCHBOT_DEVICES.get(record.address)
+    if previous is not None and SWITCHBOT_OBJECT_IDS.get(previous.object_id) is previous:
+        del SWITCHBOT_OBJECT_IDS[previous.object_id]
+    SWITCHBOT_DEVICES[record.address] = record
+    SWITCHBOT_OBJECT_IDS[record.object_id] = record
+    return record
+
+
+def device_by_object_id(object_id):
+    return SWITCHBOT_OBJECT_IDS.get(object_id)
+
+
+def device_remove(address):
+    """Forget a device, retracting its Home Assistant discovery config."""
+    record = SWITCHBOT_DEVICES.pop(address, None)
+    if record is not None and SWITCHBOT_OBJECT_IDS.get(record.object_id) is record:
+        del SWITCHBOT_OBJECT_IDS[record.object_id]
+    SWITCHBOT_DATA.pop(address, None)
+    SWITCHBOT_PUBLISHED.pop(address, None)
+    SWITCHBOT_ENERGY.pop(address, None)
+    SCANNER_SEEN.pop(address, None)
+    SWITCHBOT_AVAILABILITY.pop(address, None)
+    history_close(address)
+    homeassistant_retract(address)
+
+
+def config_reload():
+    """Apply device changes in config.ini without interrupting scanning.
+
+    Added devices are picked up by the next advertisement, removed devices
+    have their discovery config retracted and renamed devices are announced
+    under their new name. Untouched devices keep their state and energy.
+    Settings outside the device sections still require a restart.
+    """
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    try:
+        parser.read(config_path)
+        config_load_devices(parser)
+    except (configparser.Error, KeyError) as e:
+        print(f"Not reloading {config_path}: {e}")
+        return
+    registry = device_registry_build()
+    removed = [ address for address in SWITCHBOT_DEVICES if address not in registry ]
+    for address in removed:
+        device_remove(address)
+    added = 0
+    changed = 0
+    for address, record in registry.items():
+        current = SWITCHBOT_DEVICES.get(address)
+        if current is None:
+            device_register(record)
+            added += 1
+            continue
+        if record.device_type == SwitchbotDeviceType.METER and current.device_type == SwitchbotDeviceType.METER_PLUS:
+            # The meter section covers both, keep the type resolved from its advertisements
+            record = make_device_record(address, current.device_type, record.name)
+        if (current.device_type, current.name) != (record.device_type, record.name):
+            if current.device_type != record.device_type:
+                device_remove(address)
+            device_register(record)
+            SWITCHBOT_PUBLISHED.pop(address, None)
+            changed += 1
+    print(f"Reloaded {config_path}: {added} added, {len(removed)} removed, {changed} changed")
+
+
+async def config_watch():
+    """Reload the device configuration when config.ini is modified."""
+    modified = os.stat(config_path).st_mtime if os.path.exists(config_path) else None
+    while CONFIG_WATCH_PERIOD > 0:
+        await asyncio.sleep(CONFIG_WATCH_PERIOD)
+        current = os.stat(config_path).st_mtime if os.path.exists(config_path) else None
+        if current != modified:
+            modified = current
+            config_reload()
+
+
+def device_enroll(address, device_type):
+    """Admit an unknown supported device under a generated name and persist it."""
+    section = { SwitchbotDeviceType.IO_THERMOHYDRO: "io_thermohydro", SwitchbotDeviceType.PLUG_MINI: "plug_mini" }.get(device_type, "meter")
+    name = f"{SWITCHBOT_METADATA[device_type]['name']} {address.replace(':', '')[-6:]}"
+    for table_section, _, devices in DEVICE_TABLES:
+        if table_section == section:
+            devices[name] = address
+    device_register(make_device_record(address, device_type, name))
+    UNKNOWN_ENROLLED.update(address, "section", section)
+    UNKNOWN_ENROLLED.update(address, "name", name)
+    UNKNOWN_ENROLLED.compact()
+    print(f"Enrolled {device_type.name} {address} as {name}")
+
+
+def advertisement_unknown(device, data):
+    """Handle an advertisement from an address that is not configured.
+
+    Each address is looked at most once per UNKNOWN_HOLDOFF seconds. Supported
+    devices received at or above UNKNOWN_MIN_RSSI are enrolled when auto
+    enrollment is on, returning True so the advertisement is processed;
+    anything else is reported to the diagnostics topic.
+    """
+    service_data = data.service_data.get(UUID_BROADCAST)
+    if service_data is None or len(service_data) == 0:
+        return False
+    address = device.address
+    now = time.monotonic()
+    last = UNKNOWN_SEEN.get(address)
+    if last is not None and now - last < UNKNOWN_HOLDOFF:
+        return False
+    UNKNOWN_SEEN[address] = now
+    manufacturer_data = data.manufacturer_data.get(MANUFACTURER_ID)
+    if UNKNOWN_AUTO_ENROLL and data.rssi is not None and data.rssi >= UNKNOWN_MIN_RSSI:
+        advertisement = decode_advertisement(service_data, manufacturer_data)
+        if advertisement is not None:
+            device_enroll(address, advertisement.device_type)
+            return True
+    if UNKNOWN_REPORT_PERIOD > 0 and MQTT_ENABLED:
+        device_type = advertisement_device_type(service_data)
+        mqtt_send(f"{MQTT_TOPIC_PREFIX}/diagnostics/unknown", json.dumps({
+            "address": address,
+            "type": device_type.name if device_type is not None else f"0x{service_data[0] & 0x7F:02X}",
+            "rssi": data.rssi,
+            "service_data": bytes(service_data).hex().upper(),
+            "manufacturer_data": { str(key): bytes(value).hex().upper() for key, value in data.manufacturer_data.items() },
+        }))
+    return False
+
+
+def advertisement_enqueue(device, data, timestamp=None, source_time=None):
+    """Detection callback: filter by address and queue the raw frame for advertisement_worker().
+
+    Replayed and synthetic advertisements pass their recorded timestamp so
+    energy, intervals and history follow the capture rather than the replay.
+    Forwarded advertisements also pass the source time they map to locally.
+    When the queue is full a frame is dropped according to PIPELINE_OVERFLOW
+    and counted in PIPELINE_DROPPED.
+    """
+    global PIPELINE_DROPPED
+    address = device.address
+    if address not in SWITCHBOT_DEVICES:
+        if not UNKNOWN_ENABLED or not advertisement_unknown(device, data):
             return
-        buffer = [int(x) for x in data.service_data[UUID_BROADCAST]]
-        byte0_reserved = (buffer[0] & 0x80) >> 7
-        device_type = buffer[0] & 0x7F
-        if device_type in SwitchbotDeviceTypeValues:
-            device_type = SwitchbotDeviceType(device_type)
-            is_unknown = False
-            if device_type in [SwitchbotDeviceType.METER, SwitchbotDeviceType.METER_PLUS]:
-                if address not in METER_ADDRESSES:
-                    is_unknown = True
-            elif device_type == SwitchbotDeviceType.IO_THERMOHYDRO:
-                if address not in IO_THERMOHYDRO_ADDRESSES:
-                    is_unknown = True
-            elif device_type == SwitchbotDeviceType.PLUG_MINI:
-                if address not in PLUG_MINI_ADDRESSES:
-                    is_unknown = True
-            else:
-                is_unknown = True
-            if is_unknown:
-                line = f"{device_type.name}: {address} {rssi} | SD "
-                for key, value in data.service_data.items():
-                    value = ''.join([f'{int(x):02X}' for x in value])
-                    line += f"{key}: {value} "
-                line += "| MD "
-                for key, value in data.manufacturer_data.items():
-                    value = ''.join([f'{int(x):02X}' for x in value])
-                    line += f"{key}: {value} "
-                print(line)
+    service_data = data.service_data.get(UUID_BROADCAST)
+    # advertisement_coalesce() reads the device type from the first byte
+    if service_data is None or len(service_data) == 0:
+        return
+    if len(PIPELINE_QUEUE) >= PIPELINE_QUEUE_SIZE:
+        PIPELINE_DROPPED += 1
+        if PIPELINE_OVERFLOW == "drop_newest":
+            return
+        PIPELINE_QUEUE.popleft()
+    METRIC_ADVERTISEMENTS.inc((address,))
+    if timestamp is None:
+        frame = (time.monotonic(), time.time(), address, data.rssi, service_data, data.manufacturer_data.get(MANUFACTURER_ID))
+    else:
+        frame = (timestamp if source_time is None else source_time, timestamp, address, data.rssi, service_data, data.manufacturer_data.get(MANUFACTURER_ID))
+    PIPELINE_QUEUE.append(frame)
+    if PIPELINE_READY is not None:
+        PIPELINE_READY.set()
+
+
+def advertisement_callback(frame):
+    source_time, timestamp, address, rssi, service_data, manufacturer_data = frame
+    record = SWITCHBOT_DEVICES.get(address)
+    if record is None:
+        return
+    advertisement = decode_advertisement(service_data, manufacturer_data)
+    if advertisement is None:
+        return
+    if advertisement.device_type is not record.device_type:
+        record = device_registry_resolve(address, advertisement.device_type)
+    device_data = SWITCHBOT_DATA.get(address)
+    if device_data is None:
+        device_data = SWITCHBOT_DATA[address] = { }
+    repeated = False
+    if type(advertisement) is PlugMiniAdvertisement:
+        device_data['rssi'] = rssi
+        device_data['last_advertisement'] = timestamp
+        integrator = SWITCHBOT_ENERGY.get(address)
+        if integrator is None:
+            key = record.key
+            energy = SWITCHBOT_PERSISTENCE[key]['energy'] if key in SWITCHBOT_PERSISTENCE else 0.0
+            integrator = SWITCHBOT_ENERGY[address] = EnergyIntegrator(energy, ENERGY_MAX_GAP)
+        repeated = not integrator.update(advertisement.power, advertisement.sequence_number, source_time)
+        if not repeated:
+            device_data['power'] = advertisement.power
+            device_data['energy'] = integrator.energy
+            device_data['energy_error'] = integrator.error
+            device_data['enabled'] = advertisement.enabled
+            SWITCHBOT_PERSISTENCE.update(record.key, 'energy', integrator.energy)
+    else:
+        device_data['rssi'] = rssi
+        device_data['battery'] = advertisement.battery
+        device_data['temperature'] = advertisement.temperature
+        device_data['humidity'] = advertisement.humidity
+        device_data['last_advertisement'] = timestamp
+    # After the new reading is stored, so a device coming back online is published with it
+    availability_heard(record, source_time, device_data)
+    if HISTORY_ENABLED and not repeated:
+        history_record(record, timestamp, device_data)
+
+
+def advertisement_aggregate(frame):
+    """Pass each advertisement heard by any local or remote scanner on exactly once.
+
+    An advertisement repeating the payload last seen from the same address
+    within SCANNER_DEDUPE_WINDOW seconds is a copy received by another radio;
+    it only raises the reported rssi if it was received more strongly.
+    """
+    source_time, timestamp, address, rssi, service_data, manufacturer_data = frame
+    seen = SCANNER_SEEN.get(address)
+    if seen is not None and source_time - seen[2] < SCANNER_DEDUPE_WINDOW and seen[0] == service_data and seen[1] == manufacturer_data:
+        device_data = SWITCHBOT_DATA.get(address)
+        if device_data is not None and rssi > device_data['rssi']:
+            device_data['rssi'] = rssi
+        return
+    SCANNER_SEEN[address] = (service_data, manufacturer_data, source_time)
+    advertisement_callback(frame)
+
+
+def advertisement_coalesce(frames):
+    """Reduce a batch of frames to the ones that change state.
+
+    Only the newest frame of each meter is kept while every Plug Mini frame
+    is kept in order, since each contributes to the energy integration.
+    """
+    coalesced = []
+    latest = { }
+    for frame in frames:
+        if frame[4][0] & 0x7F == SwitchbotDeviceType.PLUG_MINI.value:
+            coalesced.append(frame)
         else:
-            print(f"Unknown device type {device_type}")
+            latest[frame[2]] = frame
+    coalesced.extend(latest.values())
+    return coalesced
+
 
-    scanner = BleakScanner(process_advertisement)
-    await scanner.start()
+async def advertisement_worker():
+    global PIPELINE_READY
+    PIPELINE_READY = asyncio.Event()
+    reported_drops = 0
+    report_time = time.monotonic()
     while True:
-        await asyncio.sleep(1)
+        await PIPELINE_READY.wait()
+        PIPELINE_READY.clear()
+        while len(PIPELINE_QUEUE) > 0:
+            frames = [ PIPELINE_QUEUE.popleft() for _ in range(min(len(PIPELINE_QUEUE), PIPELINE_BATCH_SIZE)) ]
+            for frame in advertisement_coalesce(frames):
+                start = time.perf_counter()
+                advertisement_aggregate(frame)
+                METRIC_ADVERTISEMENT_SECONDS.observe(time.perf_counter() - start)
+            # Let the scanners and MQTT run between batches
+            await asyncio.sleep(0)
+        if PIPELINE_DROPPED != reported_drops and time.monotonic() - report_time >= 60:
+            print(f"Advertisement queue full, dropped {PIPELINE_DROPPED - reported_drops} advertisements")
+            reported_drops = PIPELINE_DROPPED
+            report_time = time.monotonic()
+
+
+def advertisement_forward(device, data, timestamp=None):
+    """Buffer a Switchbot advertisement for forwarding to the aggregator."""
+    if UUID_BROADCAST not in data.service_data:
+        return
+    SCANNER_FORWARD_BUFFER.extend(encode_advertisement(time.time() if timestamp is None else timestamp, device.address, data.rssi, data.service_data, data.manufacturer_data))
+
+
+def advertisement_receive(payload, node):
+    """Queue advertisements forwarded by a remote scanner node.
+
+    Each advertisement keeps the time the node received it, mapped onto the
+    local monotonic clock by assuming the newest one in the batch arrived
+    without delay. Energy is then integrated on the node's spacing rather
+    than on batch arrival times, and source times from one node never go
+    backwards.
+    """
+    view = memoryview(payload)
+    offset = 0
+    advertisements = []
+    while offset < len(payload):
+        try:
+            advertisement, offset = decode_advertisement_record(view, offset)
+        except (struct.error, ValueError):
+            print("Discarding malformed forwarded advertisements")
+            break
+        advertisements.append(advertisement)
+    if len(advertisements) == 0:
+        return
+    clock_offset = time.monotonic() - max(advertisement.timestamp for advertisement in advertisements)
+    last = SCANNER_NODE_TIMES.get(node, -math.inf)
+    for advertisement in advertisements:
+        last = max(last, advertisement.timestamp + clock_offset)
+        advertisement_enqueue(advertisement, advertisement, advertisement.timestamp, last)
+    SCANNER_NODE_TIMES[node] = last
+
+
+async def switchbot_forward():
+    while SCANNER_ROLE == "node":
+        await asyncio.sleep(SCANNER_FORWARD_PERIOD)
+        if len(SCANNER_FORWARD_BUFFER) > 0:
+            mqtt_send(f"{SCANNER_RAW_TOPIC}/{SCANNER_NODE_NAME}", bytes(SCANNER_FORWARD_BUFFER))
+            SCANNER_FORWARD_BUFFER.clear()
 
 
 async def switchbot_sample():
-    def advertisement_callback(device, data):
-        global SWITCHBOT_DATA
-        global PLUG_MINI_DATA
+    """Feed advertisements from the configured source into the pipeline.
 
-        timestamp = time.time()
-        address = device.address
-        if address not in ADDRESS_TO_NAME:
-            return
-        if UUID_BROADCAST not in data.service_data:
-            return
-        name = ADDRESS_TO_NAME[address]
-        rssi = data.rssi
-        sd_buffer = [int(x) for x in data.service_data[UUID_BROADCAST]]
-        sd_byte0_reserved = (sd_buffer[0] & 0x80) >> 7
-        device_type = sd_buffer[0] & 0x7F
-        if device_type in SwitchbotDeviceTypeValues:
-            device_type = SwitchbotDeviceType(device_type)
-            key = make_device_key(device_type.name, address)
-            if device_type in [SwitchbotDeviceType.METER, SwitchbotDeviceType.METER_PLUS]:
-                sd_byte1_reserved = (sd_buffer[1] & 0xF0) >> 4
-                group_d = (sd_buffer[1] & 0x08) != 0
-                group_c = (sd_buffer[1] & 0x04) != 0
-                group_b = (sd_buffer[1] & 0x02) != 0
-                group_a = (sd_buffer[1] & 0x01) != 0
-                sd_byte2_reserved = (sd_buffer[2] & 0x80) >> 7
-                battery = (sd_buffer[2] & 0x7F)
-                temperature_alert_high = (sd_buffer[3] & 0x80) != 0
-                temperature_alert_low = (sd_buffer[3] & 0x40) != 0
-                humidity_alert_high = (sd_buffer[3] & 0x20) != 0
-                humidity_alert_low = (sd_buffer[3] & 0x10) != 0
-                fractional_temperature = sd_buffer[3] & 0x0F
-                temperature_negative = (sd_buffer[4] & 0x80) == 0
-                temperature_integer = sd_buffer[4] & 0x7F
-                temperature_c = (sd_buffer[5] & 0x80) == 0
-                temperature = temperature_integer + fractional_temperature * 0.1
-                humidity = sd_buffer[5] & 0x7F
-                if temperature_negative:
-                    temperature_integer *= -1
-                if key not in SWITCHBOT_DATA:
-                    SWITCHBOT_DATA[key] = { }
-                SWITCHBOT_DATA[key]['rssi'] = rssi
-                SWITCHBOT_DATA[key]['battery'] = battery
-                SWITCHBOT_DATA[key]['temperature'] = temperature
-                SWITCHBOT_DATA[key]['humidity'] = humidity
-                SWITCHBOT_DATA[key]['last_advertisement'] = timestamp
-            elif device_type == SwitchbotDeviceType.IO_THERMOHYDRO:
-                sd_byte1 = sd_buffer[1] # Unknown
-                sd_byte2_reserved = (sd_buffer[2] & 0x80) >> 7
-                sd_byte2_reserved = (sd_buffer[2] & 0x80) >> 7
-                battery = (sd_buffer[2] & 0x7F)
-                
-                md_buffer = [int(x) for x in data.manufacturer_data[2409]]
-                mac_address = md_buffer[0:6]
-                md_byte6_reserved = (md_buffer[6] & 0x80) >> 7
-                md_byte6_unknown = (md_buffer[6] & 0x7F)
-                md_byte7_unknown = md_buffer[7]
-                temperature_fraction = md_buffer[8] & 0x0F
-                temperature_sign = (md_buffer[9] & 0x80) == 0
-                temperature_whole = md_buffer[9] & 0x7F
-                temperature = temperature_whole + temperature_fraction * 0.1
-                if temperature_sign:
-                    temperature *= -1
-                temperature_c = (md_buffer[10] & 0x80) == 0
-                humidity = md_buffer[10] & 0x7F
-                md_byte11_unknown = md_buffer[11]
-                if key not in SWITCHBOT_DATA:
-                    SWITCHBOT_DATA[key] = { }
-                SWITCHBOT_DATA[key]['rssi'] = rssi
-                SWITCHBOT_DATA[key]['battery'] = battery
-                SWITCHBOT_DATA[key]['temperature'] = temperature
-                SWITCHBOT_DATA[key]['humidity'] = humidity
-                SWITCHBOT_DATA[key]['last_advertisement'] = timestamp
-            elif device_type == SwitchbotDeviceType.PLUG_MINI:
-                sd_byte1 = sd_buffer[1] # Unknown
-                sd_byte2_reserved = (sd_buffer[2] & 0x80) >> 7
-                sd_byte2_reserved = (sd_buffer[2] & 0x80) >> 7
-                battery = (sd_buffer[2] & 0x7F)
-
-                md_buffer = [int(x) for x in data.manufacturer_data[2409]]
-                mac_address = md_buffer[0:6]
-                sequence_number = md_buffer[6]
-                on = (md_buffer[7] & 0x80) != 0
-                delay = (md_buffer[8] & 0x01) != 0
-                timer = (md_buffer[8] & 0x02) != 0
-                utc = (md_buffer[8] & 0x04) != 0
-                wifi_rssi = md_buffer[9]
-                overload = (md_buffer[10] & 0x80) != 0
-                power = (((md_buffer[10] & 0x7F) << 8) + md_buffer[11]) * 0.1 # Watts
-                power = power / 1000.0 # Kilowatts
-                if key not in SWITCHBOT_DATA:
-                    SWITCHBOT_DATA[key] = { }
-                if 'energy' not in SWITCHBOT_DATA[key]:
-                    SWITCHBOT_DATA[key]['energy'] = SWITCHBOT_PERSISTENCE[key]['energy'] if key in SWITCHBOT_PERSISTENCE else 0.0
-                elif 'last_advertisement' in SWITCHBOT_DATA[key] and 'power' in SWITCHBOT_DATA[key]:
-                    time_delta = (timestamp - SWITCHBOT_DATA[key]['last_advertisement']) / 3600.0 # Hours
-                    min_power = min(power, SWITCHBOT_DATA[key]['power'])
-                    max_power = max(power, SWITCHBOT_DATA[key]['power'])
-                    energy = 0.5 * time_delta * (max_power - min_power) + time_delta * min_power # Kilowatt-hours
-                    SWITCHBOT_DATA[key]['energy'] += energy
-                SWITCHBOT_DATA[key]['rssi'] = rssi
-                SWITCHBOT_DATA[key]['power'] = power
-                SWITCHBOT_DATA[key]['enabled'] = on
-                SWITCHBOT_DATA[key]['last_advertisement'] = timestamp
-                if key not in SWITCHBOT_PERSISTENCE:
-                    SWITCHBOT_PERSISTENCE[key] = { }    
-                SWITCHBOT_PERSISTENCE[key]['energy'] = SWITCHBOT_DATA[key]['energy']
-    scanner = BleakScanner(advertisement_callback)
-    await scanner.start()
+    With duty_on and duty_off set the scanners are stopped for duty_off
+    seconds after every duty_on seconds of scanning.
+    """
+    global SCANNER_RESUMED
+    callback = advertisement_forward if SCANNER_ROLE == "node" else advertisement_enqueue
+    if CAPTURE_RECORD_PATH != "":
+        capture = CaptureWriter(CAPTURE_RECORD_PATH)
+        process = callback
+
+        def callback(device, data, timestamp=None):
+            capture.write(device, data, timestamp)
+            process(device, data, timestamp)
+
+    def recorded_callback(device, data):
+        callback(device, data, device.timestamp)
+
+    scanners = []
+    if CAPTURE_REPLAY_PATH != "":
+        count = await replay_capture(CAPTURE_REPLAY_PATH, recorded_callback, CAPTURE_REPLAY_SPEED)
+        print(f"Replayed {count} advertisements from {CAPTURE_REPLAY_PATH}")
+    elif len(SYNTHETIC_DEVICES) > 0:
+        await generate_synthetic(SYNTHETIC_DEVICES, recorded_callback, CAPTURE_REPLAY_SPEED)
+    else:
+        for adapter in SCANNER_ADAPTERS or [None]:
+            bluez = { }
+            if adapter is not None:
+                bluez["adapter"] = adapter
+            if SCANNER_MODE == "passive":
+                bluez["or_patterns"] = SCANNER_OR_PATTERNS
+            scanners.append(BleakScanner(callback, scanning_mode=SCANNER_MODE, bluez=bluez))
+        for scanner in scanners:
+            await scanner.start()
+    scanning = True
+    toggle_time = time.monotonic() + SCANNER_DUTY_ON
     while True:
-        await asyncio.sleep(1)
+        if SCANNER_DUTY_CYCLE and len(scanners) > 0:
+            await asyncio.sleep(max(0.0, min(1.0, toggle_time - time.monotonic())))
+            if time.monotonic() >= toggle_time:
+                for scanner in scanners:
+                    if scanning:
+                        await scanner.stop()
+                    else:
+                        await scanner.start()
+                scanning = not scanning
+                if scanning:
+                    SCANNER_RESUMED = time.monotonic()
+                toggle_time += SCANNER_DUTY_ON if scanning else SCANNER_DUTY_OFF
+        else:
+            await asyncio.sleep(1)
+        if CAPTURE_RECORD_PATH != "":
+            capture.flush()
 
 
-def homeassistant_device_config(device_key, model, name, address):
+def availability_timeout(interval):
+    """Seconds without advertisements before a device with the given smoothed interval is offline."""
+    if interval is None:
+        return AVAILABILITY_MAX_TIMEOUT + SCANNER_DUTY_OFF
+    timeout = min(max(interval * AVAILABILITY_MULTIPLIER, AVAILABILITY_MIN_TIMEOUT), AVAILABILITY_MAX_TIMEOUT)
+    return timeout + SCANNER_DUTY_OFF
+
+
+def availability_heard(record, source_time, device_data):
+    """Learn a device's advertisement interval and push back the time it goes offline.
+
+    Intervals are learned in the frames' source time; the deadline is in
+    time.monotonic(), with the timeout shortened by CAPTURE_CLOCK_RATE when a
+    capture is replayed faster than it was recorded.
+
+    A device that was offline is published as online straight away. Each
+    device has one live entry in AVAILABILITY_HEAP. Later deadlines are picked
+    up by availability_expire() when the entry comes due; an earlier deadline,
+    from a shorter learned interval, replaces the entry.
+    """
+    entry = SWITCHBOT_AVAILABILITY.get(record.address)
+    if entry is None:
+        entry = SWITCHBOT_AVAILABILITY[record.address] = { "last": source_time, "interval": None, "deadline": None, "scheduled": None, "sequence": None }
+    elif source_time > entry["last"]:
+        # Intervals spanning a duty cycle pause say nothing about the device
+        if entry["last"] >= SCANNER_RESUMED:
+            interval = source_time - entry["last"]
+            entry["interval"] = interval if entry["interval"] is None else entry["interval"] + AVAILABILITY_SMOOTHING * (interval - entry["interval"])
+        entry["last"] = source_time
+    entry["deadline"] = time.monotonic() + availability_timeout(entry["interval"]) / CAPTURE_CLOCK_RATE
+    if entry["sequence"] is None or entry["deadline"] < entry["scheduled"]:
+        entry["sequence"] = next(AVAILABILITY_SEQUENCE)
+        entry["scheduled"] = entry["deadline"]
+        heapq.heappush(AVAILABILITY_HEAP, (entry["deadline"], entry["sequence"], record.address))
+        if AVAILABILITY_WAKE is not None and AVAILABILITY_HEAP[0][1] == entry["sequence"]:
+            AVAILABILITY_WAKE.set()
+    previous = device_data.get("available")
+    device_data["available"] = "online"
+    if previous == "offline":
+        device_publish(record.address)
+
+
+def availability_expire(now):
+    """Mark devices whose deadline has passed offline, rescheduling those heard from since."""
+    while len(AVAILABILITY_HEAP) > 0 and AVAILABILITY_HEAP[0][0] <= now:
+        deadline, sequence, address = heapq.heappop(AVAILABILITY_HEAP)
+        entry = SWITCHBOT_AVAILABILITY.get(address)
+        if entry is None or entry["sequence"] != sequence:
+            continue
+        if entry["deadline"] > now:
+            entry["scheduled"] = entry["deadline"]
+            heapq.heappush(AVAILABILITY_HEAP, (entry["deadline"], sequence, address))
+            continue
+        entry["sequence"] = None
+        data = SWITCHBOT_DATA.get(address)
+        if data is not None and data.get("available") == "online":
+            data["available"] = "offline"
+            device_publish(address)
+
+
+def device_publish(address):
+    """Publish a device's state straight away, outside the mqtt_publish() cycle."""
+    if not MQTT_ENABLED or address not in SWITCHBOT_PUBLISHED:
+        return
+    record = SWITCHBOT_DEVICES[address]
+    data = SWITCHBOT_DATA[address]
+    SWITCHBOT_PUBLISHED[address] = { "time": time.time(), "data": dict(data) }
+    mqtt_send(record.state_topic, json.dumps(data))
+
+
+async def availability_scheduler():
+    """Sleep until the earliest availability deadline instead of polling every device."""
+    global AVAILABILITY_WAKE
+    AVAILABILITY_WAKE = asyncio.Event()
+    while True:
+        timeout = AVAILABILITY_HEAP[0][0] - time.monotonic() if len(AVAILABILITY_HEAP) > 0 else None
+        if timeout is None or timeout > 0:
+            try:
+                await asyncio.wait_for(AVAILABILITY_WAKE.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            AVAILABILITY_WAKE.clear()
+        availability_expire(time.monotonic())
+
+
+def publish_due(address, device_type, data, now):
+    """Decide whether a device's state should be published under its SWITCHBOT_PUBLISH_POLICY."""
+    published = SWITCHBOT_PUBLISHED.get(address)
+    if published is None:
+        return True
+    policy = SWITCHBOT_PUBLISH_POLICY[device_type]
+    elapsed = now - published["time"]
+    if elapsed < policy["min_interval"]:
+        return False
+    if elapsed >= policy["max_interval"]:
+        return True
+    deadband = policy["deadband"]
+    for field, value in data.items():
+        if field == "last_advertisement":
+            continue
+        previous = published["data"].get(field)
+        if field in deadband and previous is not None:
+            # Tolerance keeps a 0.1 step from falling short of a 0.1 deadband
+            if abs(value - previous) + 1e-9 >= deadband[field]:
+                return True
+        elif value != previous:
+            return True
+    return False
+
+
+def history_record(record, timestamp, device_data):
+    history = SWITCHBOT_HISTORY.get(record.address)
+    if history is None:
+        try:
+            history = DeviceHistory(HISTORY_CAPACITIES, HISTORY_PATH if HISTORY_PATH != "" else None, get_safe_device_key(record.key))
+        except OSError as e:
+            # e.g. out of file descriptors or disk space, keep the history in memory rather than stop processing
+            print(f"Keeping history of {record.name} in memory: {e}")
+            history = DeviceHistory(HISTORY_CAPACITIES)
+        SWITCHBOT_HISTORY[record.address] = history
+    history.add(timestamp, [ float(device_data.get(field, math.nan)) for field in HISTORY_FIELDS ])
+
+
+def history_close(address):
+    history = SWITCHBOT_HISTORY.pop(address, None)
+    if history is not None:
+        history.close()
+
+
+def history_select(history, resolution=None, since=0.0, until=math.inf, limit=HISTORY_BACKFILL_LIMIT):
+    """Query a device's history, returning (resolution, samples) with at most limit samples.
+
+    Without a resolution the finest one that covers the range within limit
+    samples is used. When even that holds too many, the latest are kept.
+    """
+    resolutions = [resolution] if resolution is not None else list(HISTORY_RESOLUTIONS)
+    for resolution in resolutions:
+        samples = history.query(resolution, since, until)
+        if len(samples) <= limit:
+            break
+    return resolution, samples[-limit:] if limit > 0 else []
+
+
+def history_request(topic, payload):
+    """Answer a query on {prefix}/{object id}/history/get with the device's history on {prefix}/{object id}/history.
+
+    The payload is an optional JSON object with resolution ("raw", "1m" or
+    "15m"), since and until (Unix timestamps) and limit.
+    """
+    record = device_by_object_id(topic[len(MQTT_TOPIC_PREFIX) + 1:-len("/history/get")])
+    if record is None:
+        return
+    try:
+        request = json.loads(payload) if payload.strip() != b"" else { }
+        resolution = request.get("resolution")
+        if resolution is not None and resolution not in HISTORY_RESOLUTIONS:
+            raise ValueError(f"Unknown resolution {resolution}")
+        since = float(request.get("since", 0.0))
+        until = float(request.get("until", math.inf))
+        limit = int(request.get("limit", HISTORY_BACKFILL_LIMIT))
+    except (ValueError, TypeError, AttributeError) as e:
+        mqtt_send(record.history_topic, json.dumps({ "error": str(e) }))
+        return
+    history = SWITCHBOT_HISTORY.get(record.address)
+    if history is None:
+        resolution, samples = resolution or "raw", []
+    else:
+        resolution, samples = history_select(history, resolution, since, until, limit)
+    mqtt_send(record.history_topic, json.dumps({ "resolution": resolution, "samples": history_samples_json(samples) }))
+
+
+def history_outage_begin():
+    global HISTORY_OFFLINE_SINCE
+    if HISTORY_OFFLINE_SINCE is None:
+        HISTORY_OFFLINE_SINCE = time.time()
+
+
+def history_outage_end():
+    """Start backfilling every device's history recorded since the outage began."""
+    global HISTORY_OFFLINE_SINCE, HISTORY_BACKFILL_TASK
+    if not HISTORY_ENABLED or HISTORY_OFFLINE_SINCE is None:
+        return
+    HISTORY_BACKFILL_TASK = asyncio.get_running_loop().create_task(history_backfill(HISTORY_OFFLINE_SINCE))
+    HISTORY_OFFLINE_SINCE = None
+
+
+async def history_backfill(since):
+    """Publish each device's samples since an outage to its history topic, yielding between devices."""
+    count = 0
+    for address, history in list(SWITCHBOT_HISTORY.items()):
+        record = SWITCHBOT_DEVICES.get(address)
+        if record is None:
+            continue
+        resolution, samples = history_select(history, since=since)
+        if len(samples) > 0:
+            mqtt_send(record.history_topic, json.dumps({ "resolution": resolution, "backfill": True, "samples": history_samples_json(samples) }))
+            count += 1
+        await asyncio.sleep(0)
+    print(f"Backfilled history of {count} devices since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since))}")
+
+
+def homeassistant_device_config(record):
     return {
-        "connections": [["mac", address]],
+        "connections": [["mac", record.address]],
         # "hw_version" "",
-        "identifiers": [get_safe_name(f"{MQTT_TOPIC_PREFIX}_{device_key}")],
+        "identifiers": [get_safe_name(f"{MQTT_TOPIC_PREFIX}_{get_safe_device_key(record.key)}")],
         "manufacturer": "Switchbot",
-        "model": model,
+        "model": SWITCHBOT_METADATA[record.device_type]["name"],
         # "model_id": "",
-        "name": name,
+        "name": record.name,
         # "serial_number": serial_number,
         # "suggested_area": "",
         # "sw_version": "",
@@ -302,61 +913,295 @@ def homeassistant_device_config(device_key, model, name, address):
     }
 
 
-def homeassistant_config(device_config, device_key, field, name, state_class, device_class, unit_of_measurement):
-    device_type, address = split_device_key(device_key)
-    fixed_address = address.replace("_", ":")
-    device_name = ADDRESS_TO_NAME[fixed_address]
+def homeassistant_config(record, device_config, field, topic):
+    field_data = SWITCHBOT_METADATA[record.device_type]["fields"][field]
     payload_json = {
-        "unique_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{get_safe_name(device_type)}_{get_safe_name(device_name)}_{get_safe_name(field)}"),
-        "object_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{get_safe_name(device_type)}_{get_safe_name(device_name)}_{get_safe_name(field)}"),
-        "name": name,
-        "state_topic": f"{MQTT_TOPIC_PREFIX}/{get_safe_name(device_type)}_{get_safe_name(device_name)}/data",
+        "unique_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{record.object_id}_{get_safe_name(field)}"),
+        "object_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{record.object_id}_{get_safe_name(field)}"),
+        "name": field_data["name"],
+        "state_topic": record.state_topic,
         "value_template": "{{ value_json." + field + " }}",
         "device": device_config,
-        "availability_topic": f"{MQTT_TOPIC_PREFIX}/{get_safe_name(device_type)}_{get_safe_name(device_name)}/data",
+        "availability_topic": record.state_topic,
         "availability_template": "{{ value_json.available }}",
     }
-    if state_class is not None:
-        payload_json["state_class"] = state_class
-    if device_class is not None:
-        payload_json["device_class"] = device_class
-    if unit_of_measurement is not None:
-        payload_json["unit_of_measurement"] = unit_of_measurement
+    if field_data["state_class"] is not None:
+        payload_json["state_class"] = field_data["state_class"]
+    if field_data["device_class"] is not None:
+        payload_json["device_class"] = field_data["device_class"]
+    if field_data["unit_of_measurement"] is not None:
+        payload_json["unit_of_measurement"] = field_data["unit_of_measurement"]
     return {
-        "topic": f"homeassistant/sensor/{MQTT_TOPIC_PREFIX}_{get_safe_name(device_type)}_{get_safe_name(device_name)}/{field}/config",
+        "topic": topic,
         "payload": json.dumps(payload_json)
     }
 
 
+def homeassistant_switch_config(record, device_config):
+    payload_json = {
+        "unique_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{record.object_id}_switch"),
+        "object_id": get_safe_name(f"{MQTT_TOPIC_PREFIX}_{record.object_id}_switch"),
+        "name": "Switch",
+        "command_topic": record.command_topic,
+        "payload_on": "on",
+        "payload_off": "off",
+        "state_topic": record.state_topic,
+        "value_template": "{{ 'on' if value_json.enabled else 'off' }}",
+        "state_on": "on",
+        "state_off": "off",
+        "device": device_config,
+        "availability_topic": record.state_topic,
+        "availability_template": "{{ value_json.available }}",
+    }
+    return {
+        "topic": f"homeassistant/switch/{MQTT_TOPIC_PREFIX}_{record.object_id}/switch/config",
+        "payload": json.dumps(payload_json)
+    }
+
+
+def homeassistant_discovery_messages(record):
+    device_config = homeassistant_device_config(record)
+    messages = [ homeassistant_config(record, device_config, field, topic) for field, topic in record.discovery_topics ]
+    if COMMANDS_ENABLED and record.device_type == SwitchbotDeviceType.PLUG_MINI:
+        messages.append(homeassistant_switch_config(record, device_config))
+    return messages
+
+
+def homeassistant_announce(record):
+    """Publish retained discovery config for a device the first time it is seen.
+
+    Serialized payloads are cached per address and only rebuilt when the
+    device record changes; topics that disappear in the rebuild are cleared.
+    """
+    entry = HOMEASSISTANT_DISCOVERY.get(record.address)
+    if entry is not None and entry["record"] == record:
+        return
+    messages = homeassistant_discovery_messages(record)
+    if entry is not None:
+        topics = set(message["topic"] for message in messages)
+        for message in entry["messages"]:
+            if message["topic"] not in topics:
+                mqtt_send(message["topic"], "", retain=True)
+    HOMEASSISTANT_DISCOVERY[record.address] = { "record": record, "messages": messages }
+    for message in messages:
+        mqtt_send(message["topic"], message["payload"], retain=True)
+
+
+def homeassistant_retract(address):
+    entry = HOMEASSISTANT_DISCOVERY.pop(address, None)
+    if entry is not None:
+        for message in entry["messages"]:
+            mqtt_send(message["topic"], "", retain=True)
+
+
+def homeassistant_announce_all():
+    """Resend discovery config and every device's state after Home Assistant restarts.
+
+    State topics are not retained, so forgetting what was published makes the
+    next mqtt_publish() cycle send every device rather than waiting for its
+    heartbeat, during which Home Assistant would show it unavailable.
+    """
+    for entry in HOMEASSISTANT_DISCOVERY.values():
+        for message in entry["messages"]:
+            mqtt_send(message["topic"], message["payload"], retain=True)
+    SWITCHBOT_PUBLISHED.clear()
+
+
+def command_client(address):
+    bluez = { "adapter": SCANNER_ADAPTERS[0] } if len(SCANNER_ADAPTERS) > 0 else { }
+    return BleakClient(address, timeout=COMMANDS_TIMEOUT, bluez=bluez)
+
+
+COMMAND_POOL = GattPool(command_client, COMMANDS_POOL_SIZE, COMMANDS_IDLE_TIMEOUT, COMMANDS_TIMEOUT)
+
+
+def command_request(topic, payload):
+    """Start the command published to {prefix}/{object id}/set, e.g. on, off, toggle or state for a Plug Mini."""
+    record = device_by_object_id(topic[len(MQTT_TOPIC_PREFIX) + 1:-len("/set")])
+    if record is None:
+        return
+    command = payload.decode(errors="replace").strip().lower()
+    task = asyncio.get_running_loop().create_task(command_run(record, command))
+    COMMAND_TASKS.add(task)
+    task.add_done_callback(COMMAND_TASKS.discard)
+
+
+async def command_run(record, command):
+    """Send a command to a device and publish the outcome to {prefix}/{object id}/result.
+
+    Values in the response, such as a plug's new state, are also applied to
+    the device's state and published straight away.
+    """
+    commands, decode = SWITCHBOT_COMMANDS.get(record.device_type, ({ }, None))
+    if command not in commands:
+        mqtt_send(record.result_topic, json.dumps({ "command": command, "status": "error", "error": f"{SWITCHBOT_METADATA[record.device_type]['name']} does not support {command}" }))
+        return
+    start = time.perf_counter()
+    try:
+        values = decode(await COMMAND_POOL.command(record.address, commands[command]))
+    except CommandError as e:
+        print(f"{record.name} command {command} failed: {e}")
+        METRIC_COMMANDS.inc(("error",))
+        mqtt_send(record.result_topic, json.dumps({ "command": command, "status": "error", "error": str(e) }))
+        return
+    METRIC_COMMANDS.inc(("ok",))
+    METRIC_COMMAND_SECONDS.observe(time.perf_counter() - start)
+    data = SWITCHBOT_DATA.get(record.address)
+    if data is not None and SWITCHBOT_DEVICES.get(record.address) is record:
+        data.update(values)
+        device_publish(record.address)
+    mqtt_send(record.result_topic, json.dumps({ "command": command, "status": "ok", **values }))
+
+
+async def command_maintain():
+    """Close GATT connections left idle and all of them on shutdown."""
+    if not COMMANDS_ENABLED:
+        return
+    try:
+        while True:
+            await asyncio.sleep(1)
+            await COMMAND_POOL.evict_idle()
+    finally:
+        await COMMAND_POOL.close()
+
+
+def mqtt_send(topic, payload, retain=False):
+    """Publish through the persistent client, queueing while the broker is unreachable.
+
+    The offline queue is bounded by MQTT_QUEUE_SIZE; once full the oldest
+    messages are discarded first.
+    """
+    METRIC_MESSAGES.inc()
+    if MQTT_CLIENT is not None and MQTT_CLIENT.is_connected():
+        info = MQTT_CLIENT.publish(topic, payload, qos=MQTT_QOS, retain=retain)
+        if info.rc != mqtt.MQTT_ERR_NO_CONN:
+            return
+    MQTT_PENDING.append((topic, payload, retain))
+
+
+def mqtt_flush_pending():
+    while len(MQTT_PENDING) > 0 and MQTT_CLIENT.is_connected():
+        topic, payload, retain = MQTT_PENDING.popleft()
+        info = MQTT_CLIENT.publish(topic, payload, qos=MQTT_QOS, retain=retain)
+        if info.rc == mqtt.MQTT_ERR_NO_CONN:
+            MQTT_PENDING.appendleft((topic, payload, retain))
+            break
+
+
+async def mqtt_loop():
+    """Own a single long-lived MQTT connection driven by the asyncio loop.
+
+    Socket reads and writes are dispatched through loop.add_reader/add_writer,
+    keepalive is serviced once a second and the (blocking) TCP connect runs in
+    an executor so BLE callbacks are never stalled by the broker.
+    """
+    global MQTT_CLIENT
+    if not MQTT_ENABLED:
+        return
+    loop = asyncio.get_running_loop()
+
+    def on_socket_open(client, userdata, sock):
+        loop.call_soon_threadsafe(loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_socket_close(client, userdata, sock):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(client, userdata, sock):
+        loop.call_soon_threadsafe(loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(client, userdata, sock):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(loop.remove_writer, sock.fileno())
+
+    # Seconds to wait before the next connection attempt, only reset once the broker accepts
+    backoff = 1.0
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        nonlocal backoff
+        if reason_code.is_failure:
+            print(f"MQTT connection refused: {reason_code}")
+            return
+        backoff = 1.0
+        print(f"MQTT connected to {MQTT_HOST}:{MQTT_PORT}")
+        METRIC_CONNECTS.inc()
+        client.publish(MQTT_STATUS_TOPIC, "online", qos=MQTT_QOS, retain=True)
+        if HOMEASSISTANT_SEND_CONFIG:
+            client.subscribe(HOMEASSISTANT_STATUS_TOPIC, qos=MQTT_QOS)
+        if SCANNER_ROLE == "aggregator":
+            client.subscribe(f"{SCANNER_RAW_TOPIC}/+", qos=MQTT_QOS)
+        if HISTORY_ENABLED:
+            client.subscribe(f"{MQTT_TOPIC_PREFIX}/+/history/get", qos=MQTT_QOS)
+        if COMMANDS_ENABLED:
+            client.subscribe(f"{MQTT_TOPIC_PREFIX}/+/set", qos=MQTT_QOS)
+        mqtt_flush_pending()
+        history_outage_end()
+
+    def on_message(client, userdata, message):
+        if message.topic == HOMEASSISTANT_STATUS_TOPIC and message.payload == b"online":
+            homeassistant_announce_all()
+            history_outage_end()
+        elif message.topic == HOMEASSISTANT_STATUS_TOPIC and message.payload == b"offline":
+            history_outage_begin()
+        elif HISTORY_ENABLED and message.topic.endswith("/history/get"):
+            history_request(message.topic, message.payload)
+        elif COMMANDS_ENABLED and message.topic.endswith("/set"):
+            command_request(message.topic, message.payload)
+        elif SCANNER_ROLE == "aggregator" and message.topic.startswith(f"{SCANNER_RAW_TOPIC}/"):
+            advertisement_receive(message.payload, message.topic[len(SCANNER_RAW_TOPIC) + 1:])
+
+    def on_disconnect(client, userdata, flags, reason_code, properties):
+        print(f"MQTT disconnected: {reason_code}")
+        history_outage_begin()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_CLIENT_ID)
+    if MQTT_USERNAME != "":
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.will_set(MQTT_STATUS_TOPIC, "offline", qos=MQTT_QOS, retain=True)
+    client.max_queued_messages_set(MQTT_QUEUE_SIZE)
+    client.on_socket_open = on_socket_open
+    client.on_socket_close = on_socket_close
+    client.on_socket_register_write = on_socket_register_write
+    client.on_socket_unregister_write = on_socket_unregister_write
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    MQTT_CLIENT = client
+
+    attempted = False
+    while True:
+        if client.socket() is None:
+            if attempted:
+                # Unreachable, refused or dropped: back off until the broker accepts a connection
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MQTT_RECONNECT_MAX)
+            attempted = True
+            try:
+                await loop.run_in_executor(None, client.connect, MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
+            except OSError as e:
+                print(f"MQTT connection to {MQTT_HOST}:{MQTT_PORT} failed: {e}")
+                history_outage_begin()
+                continue
+        client.loop_misc()
+        await asyncio.sleep(1)
+
+
 async def mqtt_publish():
     target_time = time.time() + MQTT_PUBLISH_PERIOD
     while True:
         if not MQTT_ENABLED:
             pass
         else:
-            messages = []
-            for device_key, data in SWITCHBOT_DATA.items():
-                safe_device_key = device_key.replace(":", "_")
-                device_type, address = split_device_key(device_key)
-                device_type = SwitchbotDeviceType[device_type]
-                fixed_address = address.replace("_", ":")
-                device_name = ADDRESS_TO_NAME[fixed_address]
-                data["available"] = "online" if (time.time() - data["last_advertisement"]) < 60 else "offline"
-                for prefix in SWITCHBOT_METADATA:
-                    if device_type == prefix:
-                        model = SWITCHBOT_METADATA[prefix]["name"]
-                        device_config = homeassistant_device_config(safe_device_key, model, device_name, fixed_address)
-                        for field in SWITCHBOT_METADATA[prefix]["fields"]:
-                            field_data = SWITCHBOT_METADATA[prefix]["fields"][field]
-                            field_config = homeassistant_config(device_config, safe_device_key, field, field_data["name"], field_data["state_class"], field_data["device_class"], field_data["unit_of_measurement"])
-                            if HOMEASSISTANT_SEND_CONFIG:
-                                messages.append(field_config)
-                messages.append({ "topic": f"{MQTT_TOPIC_PREFIX}/{get_safe_name(device_type.name)}_{get_safe_name(device_name)}/data", "payload": json.dumps(data) })
-            if len(messages) > 0:
-                auth = None
-                if MQTT_USERNAME != "":
-                    auth = { "username": MQTT_USERNAME, "password": MQTT_PASSWORD }
-                publish.multiple(messages, hostname=MQTT_HOST, port=MQTT_PORT, auth=auth)
+            start = time.perf_counter()
+            now = time.time()
+            for address, data in SWITCHBOT_DATA.items():
+                record = SWITCHBOT_DEVICES[address]
+                if HOMEASSISTANT_SEND_CONFIG:
+                    homeassistant_announce(record)
+                if publish_due(address, record.device_type, data, now):
+                    SWITCHBOT_PUBLISHED[address] = { "time": now, "data": dict(data) }
+                    mqtt_send(record.state_topic, json.dumps(data))
+            METRIC_PUBLISH_SECONDS.observe(time.perf_counter() - start)
         sleep_time = target_time - time.time()
         await asyncio.sleep(sleep_time)
         target_time += MQTT_PUBLISH_PERIOD
@@ -365,56 +1210,47 @@ async def mqtt_publish():
 async def save_persistence():
     while PERSISTENCE_ENABLED:
         await asyncio.sleep(PERSISTENCE_SAVE_PERIOD)
-        with open(PERSISTENCE_PATH, "w") as f:
-            json.dump(SWITCHBOT_PERSISTENCE, f)
+        start = time.perf_counter()
+        SWITCHBOT_PERSISTENCE.flush()
+        METRIC_PERSISTENCE_SECONDS.observe(time.perf_counter() - start)
+
+
+async def metrics_serve():
+    if METRICS_ENABLED:
+        await serve_metrics(METRICS_HOST, METRICS_PORT)
+
+
+async def metrics_publish():
+    while METRICS_ENABLED and MQTT_ENABLED and METRICS_MQTT_PERIOD > 0:
+        await asyncio.sleep(METRICS_MQTT_PERIOD)
+        mqtt_send(f"{MQTT_TOPIC_PREFIX}/diagnostics", json.dumps(snapshot_metrics()))
 
 
 async def main():
+    for record in device_registry_build().values():
+        device_register(record)
     if PERSISTENCE_ENABLED:
-        if os.path.exists(PERSISTENCE_PATH):
-            with open(PERSISTENCE_PATH, "r") as f:
-                SWITCHBOT_PERSISTENCE = json.load(f)
-
-    await asyncio.gather(switchbot_sample(), mqtt_publish(), save_persistence())
-
-
-asyncio.run(main())
-
-# async def meter_loop(name, address):
-#     # Get device for meter
-#     device = None
-#     while True:
-#         try:
-#             device = await BleakScanner.find_device_by_address(address)
-#             if device is None:
-#                 await asyncio.sleep(5)
-#                 continue
-#             else:
-#                 break
-#         except:
-#             await asyncio.sleep(5)
-#     # Get client for meter
-#     client = BleakClient(device)
-#     while True:
-#         # Connect to meter
-#         if not client.is_connected:
-#             # Keep retrying to connect regardless of error
-#             while True:
-#                 try:
-#                     await client.connect()
-#                     await client.start_notify(UUID_RESPONSE, device_response)
-#                     break
-#                 except:
-#                     await asyncio.sleep(5)
-#         # Send request to meter forever
-#         try:
-#             while True:
-#                 # Meter request
-#                 packet = bytearray([0x57, 0x0F, 0x31]) # Read Display Mode and Value of Meter
-#                 # Append name to response queue
-#                 queue.append(name)
-#                 await client.write_gatt_char(UUID_REQUEST, packet, response=True)
-#                 await asyncio.sleep(5)
-#         except:
-#             queue.pop(len(queue)-1)
-#             await asyncio.sleep(5)
\ No newline at end of file
+        SWITCHBOT_PERSISTENCE.load()
+    if HISTORY_ENABLED and HISTORY_PATH != "":
+        os.makedirs(HISTORY_PATH, exist_ok=True)
+
+    # Stop cleanly on SIGTERM/SIGINT so unsaved energy is flushed below
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    loop.add_signal_handler(signal.SIGHUP, config_reload)
+
+    try:
+        await asyncio.gather(advertisement_worker(), switchbot_sample(), switchbot_forward(), mqtt_loop(), mqtt_publish(), availability_scheduler(), command_maintain(), save_persistence(), metrics_serve(), metrics_publish(), config_watch())
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if PERSISTENCE_ENABLED:
+            SWITCHBOT_PERSISTENCE.flush()
+        for history in SWITCHBOT_HISTORY.values():
+            history.flush()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import heapq
+import math
+import random
+import struct
+import time
+import uuid
+
+from switchbot_decoder import MANUFACTURER_ID, UUID_BROADCAST, SwitchbotDeviceType
+
+# File header followed by one record per advertisement:
+# [timestamp f64][address x6][rssi i8][service data count][manufacturer data count]
+# then per service data entry [uuid x16][length u16][data] and per manufacturer
+# data entry [company id u16][length u16][data]. All integers are little endian.
+CAPTURE_MAGIC = b"SBCAP\x01"
+CAPTURE_RECORD = struct.Struct("<d6sbBB")
+CAPTURE_SERVICE_DATA = struct.Struct("<16sH")
+CAPTURE_MANUFACTURER_DATA = struct.Struct("<HH")
+
+
+class CapturedAdvertisement:
+    """A recorded advertisement.
+
+    It carries both the device and advertisement data attributes a Bleak
+    detection callback reads, so it can be passed as both arguments.
+    """
+    __slots__ = ("timestamp", "address", "rssi", "service_data", "manufacturer_data")
+
+    def __init__(self, timestamp, address, rssi, service_data, manufacturer_data):
+        self.timestamp = timestamp
+        self.address = address
+        self.rssi = rssi
+        self.service_data = service_data
+        self.manufacturer_data = manufacturer_data
+
+
+def address_to_bytes(address):
+    return bytes.fromhex(address.replace(":", ""))
+
+
+def bytes_to_address(buffer):
+    return ":".join(f"{x:02X}" for x in buffer)
+
+
+def encode_advertisement(timestamp, address, rssi, service_data, manufacturer_data):
+    rssi = max(-128, min(127, rssi if rssi is not None else -128))
+    parts = [CAPTURE_RECORD.pack(timestamp, address_to_bytes(address), rssi, len(service_data), len(manufacturer_data))]
+    for key, value in service_data.items():
+        parts.append(CAPTURE_SERVICE_DATA.pack(uuid.UUID(key).bytes, len(value)))
+        parts.append(bytes(value))
+    for key, value in manufacturer_data.items():
+        parts.append(CAPTURE_MANUFACTURER_DATA.pack(key, len(value)))
+        parts.append(bytes(value))
+    return b"".join(parts)
+
+
+def decode_advertisement_record(buffer, offset=0):
+    """Decode the record at offset, returning (CapturedAdvertisement, next offset)."""
+    timestamp, address, rssi, service_count, manufacturer_count = CAPTURE_RECORD.unpack_from(buffer, offset)
+    offset += CAPTURE_RECORD.size
+    service_data = { }
+    for _ in range(service_count):
+        key, length = CAPTURE_SERVICE_DATA.unpack_from(buffer, offset)
+        offset += CAPTURE_SERVICE_DATA.size
+        service_data[str(uuid.UUID(bytes=key))] = bytes(buffer[offset:offset + length])
+        offset += length
+    manufacturer_data = { }
+    for _ in range(manufacturer_count):
+        key, length = CAPTURE_MANUFACTURER_DATA.unpack_from(buffer, offset)
+        offset += CAPTURE_MANUFACTURER_DATA.size
+        manufacturer_data[key] = bytes(buffer[offset:offset + length])
+        offset += length
+    return CapturedAdvertisement(timestamp, bytes_to_address(address), rssi, service_data, manufacturer_data), offset
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+
+    def write(self, device, data, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        self.file.write(encode_advertisement(timestamp, device.address, data.rssi, data.service_data, data.manufacturer_data))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    with open(path, "rb") as f:
+        buffer = f.read()
+    if not buffer.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{path} is not a Switchbot capture file")
+    view = memoryview(buffer)
+    offset = len(CAPTURE_MAGIC)
+    while offset < len(buffer):
+        try:
+            advertisement, offset = decode_advertisement_record(view, offset)
+        except struct.error:
+            # Capture was cut off mid-record, e.g. by a crash while recording
+            return
+        yield advertisement
+
+
+async def replay_capture(path, callback, speed=1.0):
+    """Feed a capture into a detection callback.
+
+    Advertisements are delivered with their recorded spacing divided by speed;
+    a speed of 0 replays as fast as possible, yielding to the event loop
+    between batches.
+    """
+    start = None
+    replay_start = time.monotonic()
+    count = 0
+    for advertisement in read_capture(path):
+        if start is None:
+            start = advertisement.timestamp
+        if speed > 0:
+            delay = (advertisement.timestamp - start) / speed - (time.monotonic() - replay_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            await asyncio.sleep(0)
+        callback(advertisement, advertisement)
+        count += 1
+    return count
+
+
+def synthetic_devices(meters, plugs):
+    """Generate (device type, name, address) tuples for a simulated installation."""
+    devices = []
+    for index in range(meters):
+        devices.append((SwitchbotDeviceType.METER, f"Synthetic Meter {index}", bytes_to_address(bytes([0xC0, 0x00]) + index.to_bytes(4, "big"))))
+    for index in range(plugs):
+        devices.append((SwitchbotDeviceType.PLUG_MINI, f"Synthetic Plug {index}", bytes_to_address(bytes([0xC0, 0x01]) + index.to_bytes(4, "big"))))
+    return devices
+
+
+def synthetic_advertisement(device_type, address, timestamp, sequence_number):
+    phase = int(address_to_bytes(address)[-1]) + timestamp / 600.0
+    rssi = -60 + random.randint(-15, 15)
+    if device_type == SwitchbotDeviceType.PLUG_MINI:
+        power = int(max(0.0, 600.0 + 400.0 * math.sin(phase))) # Tenths of a watt
+        manufacturer_data = address_to_bytes(address) + bytes([sequence_number & 0xFF, 0x80, 0x00, 0x00, (power >> 8) & 0x7F, power & 0xFF])
+        service_data = bytes([device_type.value, 0x00, 0x00])
+        return CapturedAdvertisement(timestamp, address, rssi, { UUID_BROADCAST: service_data }, { MANUFACTURER_ID: manufacturer_data })
+    temperature = 20.0 + 5.0 * math.sin(phase)
+    whole = int(abs(temperature))
+    fraction = int(round((abs(temperature) - whole) * 10)) % 10
+    humidity = int(50 + 20 * math.cos(phase))
+    service_data = bytes([device_type.value, 0x00, 100, fraction, (0x80 if temperature >= 0 else 0x00) | whole, humidity])
+    return CapturedAdvertisement(timestamp, address, rssi, { UUID_BROADCAST: service_data }, { })
+
+
+def synthetic_advertisements(devices, start, duration, meter_interval=2.0, plug_interval=1.0):
+    """Yield synthetic advertisements in timestamp order for duration seconds."""
+    schedule = []
+    for index, (device_type, name, address) in enumerate(devices):
+        interval = plug_interval if device_type == SwitchbotDeviceType.PLUG_MINI else meter_interval
+        schedule.append((start + random.uniform(0, interval), index, interval, 0))
+    heapq.heapify(schedule)
+    while len(schedule) > 0 and schedule[0][0] < start + duration:
+        timestamp, index, interval, sequence_number = heapq.heappop(schedule)
+        device_type, name, address = devices[index]
+        yield synthetic_advertisement(device_type, address, timestamp, sequence_number)
+        heapq.heappush(schedule, (timestamp + interval * random.uniform(0.9, 1.1), index, interval, sequence_number + 1))
+
+
+async def generate_synthetic(devices, callback, speed=1.0):
+    """Drive a detection callback with synthetic advertisements forever."""
+    start = time.time()
+    replay_start = time.monotonic()
+    count = 0
+    for advertisement in synthetic_advertisements(devices, start, math.inf):
+        if speed > 0:
+            delay = (advertisement.timestamp - start) / speed - (time.monotonic() - replay_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 1000 == 0:
+            await asyncio.sleep(0)
+        callback(advertisement, advertisement)
+        count += 1
+
+
+def write_synthetic_capture(path, meters, plugs, duration):
+    writer = CaptureWriter(path)
+    count = 0
+    for advertisement in synthetic_advertisements(synthetic_devices(meters, plugs), time.time(), duration):
+        writer.write(advertisement, advertisement, advertisement.timestamp)
+        count += 1
+    writer.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or generate Switchbot advertisement captures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info = subparsers.add_parser("info", help="summarize a capture file")
+    info.add_argument("path")
+    synthesize = subparsers.add_parser("synthesize", help="write a capture of simulated meters and plugs")
+    synthesize.add_argument("path")
+    synthesize.add_argument("--meters", type=int, default=1000)
+    synthesize.add_argument("--plugs", type=int, default=100)
+    synthesize.add_argument("--duration", type=float, default=60.0)
+    args = parser.parse_args()
+
+    if args.command == "info":
+        count = 0
+        addresses = set()
+        first = last = None
+        for advertisement in read_capture(args.path):
+            count += 1
+            addresses.add(advertisement.address)
+            first = advertisement.timestamp if first is None else first
+            last = advertisement.timestamp
+        duration = (last - first) if count > 0 else 0.0
+        print(f"{count} advertisements from {len(addresses)} devices over {duration:.1f} s")
+    elif args.command == "synthesize":
+        count = write_synthetic_capture(args.path, args.meters, args.plugs, args.duration)
+        print(f"Wrote {count} advertisements to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
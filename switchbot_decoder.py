@@ -0,0 +1,116 @@
+import struct
+
+from enum import Enum
+
+MANUFACTURER_ID = 0x0969
+UUID_BROADCAST = "0000fd3d-0000-1000-8000-00805f9b34fb"
+
+
+class SwitchbotDeviceType(Enum):
+    BOT = 0x48              # Not supported
+    METER = 0x54
+    CURTAIN = 0x63          # Not supported
+    CONTACT_SENSOR = 0x64   # Not supported
+    HUMIDIFIER = 0x65       # Not supported
+    PLUG_MINI = 0x67
+    METER_PLUS = 0x69
+    SMART_LOCK = 0x6F       # Not supported
+    LED_STRIP = 0x72        # Not supported
+    MOTION_SENSOR = 0x73    # Not supported
+    COLOR_BULB = 0x75       # Not supported
+    IO_THERMOHYDRO = 0x77
+    CURTAIN_3 = 0x7B        # Not supported
+
+SWITCHBOT_DEVICE_TYPES = { item.value: item for item in SwitchbotDeviceType }
+
+# Service data: [type][flags][battery][alerts|temp fraction][sign|temp][unit|humidity]
+METER_SERVICE_DATA = struct.Struct(">2xBBBB")
+# Service data: [type][unknown][battery]
+BATTERY_SERVICE_DATA = struct.Struct(">2xB")
+# Manufacturer data: [mac x6][unknown][unknown][temp fraction][sign|temp][unit|humidity][unknown]
+IO_THERMOHYDRO_MANUFACTURER_DATA = struct.Struct(">8xBBB")
+# Manufacturer data: [mac x6][sequence][on|...][flags][wifi rssi][overload|power x2]
+PLUG_MINI_MANUFACTURER_DATA = struct.Struct(">6xBB2xH")
+
+
+class ThermohydroAdvertisement:
+    __slots__ = ("device_type", "battery", "temperature", "humidity")
+
+    def __init__(self, device_type, battery, temperature, humidity):
+        self.device_type = device_type
+        self.battery = battery
+        self.temperature = temperature
+        self.humidity = humidity
+
+
+class PlugMiniAdvertisement:
+    __slots__ = ("device_type", "sequence_number", "enabled", "overload", "power")
+
+    def __init__(self, device_type, sequence_number, enabled, overload, power):
+        self.device_type = device_type
+        self.sequence_number = sequence_number
+        self.enabled = enabled
+        self.overload = overload
+        self.power = power
+
+
+def decode_meter(device_type, service_data, manufacturer_data):
+    if len(service_data) < METER_SERVICE_DATA.size:
+        return None
+    battery, fraction, whole, humidity = METER_SERVICE_DATA.unpack_from(service_data)
+    temperature = (whole & 0x7F) + (fraction & 0x0F) * 0.1
+    if not whole & 0x80:
+        temperature = -temperature
+    return ThermohydroAdvertisement(device_type, battery & 0x7F, temperature, humidity & 0x7F)
+
+
+def decode_io_thermohydro(device_type, service_data, manufacturer_data):
+    if len(service_data) < BATTERY_SERVICE_DATA.size:
+        return None
+    if manufacturer_data is None or len(manufacturer_data) < IO_THERMOHYDRO_MANUFACTURER_DATA.size:
+        return None
+    battery, = BATTERY_SERVICE_DATA.unpack_from(service_data)
+    fraction, whole, humidity = IO_THERMOHYDRO_MANUFACTURER_DATA.unpack_from(manufacturer_data)
+    temperature = (whole & 0x7F) + (fraction & 0x0F) * 0.1
+    if not whole & 0x80:
+        temperature = -temperature
+    return ThermohydroAdvertisement(device_type, battery & 0x7F, temperature, humidity & 0x7F)
+
+
+def decode_plug_mini(device_type, service_data, manufacturer_data):
+    if manufacturer_data is None or len(manufacturer_data) < PLUG_MINI_MANUFACTURER_DATA.size:
+        return None
+    sequence_number, state, power = PLUG_MINI_MANUFACTURER_DATA.unpack_from(manufacturer_data)
+    return PlugMiniAdvertisement(device_type, sequence_number, (state & 0x80) != 0, (power & 0x8000) != 0, (power & 0x7FFF) * 0.0001) # Kilowatts
+
+
+SWITCHBOT_DECODERS = {
+    SwitchbotDeviceType.METER.value: (SwitchbotDeviceType.METER, decode_meter),
+    SwitchbotDeviceType.METER_PLUS.value: (SwitchbotDeviceType.METER_PLUS, decode_meter),
+    SwitchbotDeviceType.IO_THERMOHYDRO.value: (SwitchbotDeviceType.IO_THERMOHYDRO, decode_io_thermohydro),
+    SwitchbotDeviceType.PLUG_MINI.value: (SwitchbotDeviceType.PLUG_MINI, decode_plug_mini),
+}
+
+
+def advertisement_device_type(service_data):
+    """Return the SwitchbotDeviceType announced in service data, or None if unknown."""
+    if len(service_data) == 0:
+        return None
+    return SWITCHBOT_DEVICE_TYPES.get(service_data[0] & 0x7F)
+
+
+def decode_advertisement(service_data, manufacturer_data=None):
+    """Decode a Switchbot broadcast straight from its bytes.
+
+    service_data is the payload for the broadcast service UUID and
+    manufacturer_data the payload for MANUFACTURER_ID (or None). Returns a
+    ThermohydroAdvertisement or PlugMiniAdvertisement, or None when the device
+    type is unsupported or the payload is truncated.
+    """
+    if len(service_data) == 0:
+        return None
+    decoder = SWITCHBOT_DECODERS.get(service_data[0] & 0x7F)
+    if decoder is None:
+        return None
+    return decoder[1](decoder[0], service_data, manufacturer_data)
+
@@ -0,0 +1,55 @@
+class EnergyIntegrator:
+    """Integrates Plug Mini power advertisements into energy.
+
+    Power is integrated with the trapezoid rule between consecutive
+    advertisements using monotonic timestamps. Repeated advertisements that
+    carry the same sequence number are ignored. Gaps longer than max_gap
+    seconds are flagged and only the first max_gap seconds are integrated.
+
+    energy_low and energy_high bound the energy accumulated since creation: the
+    power between two advertisements is assumed to stay within the two
+    readings, and for the unintegrated part of a gap anywhere between zero and
+    the larger of the two readings.
+    """
+    __slots__ = ("energy", "energy_low", "energy_high", "max_gap", "gaps", "last_time", "last_power", "last_sequence")
+
+    def __init__(self, energy=0.0, max_gap=60.0):
+        self.energy = energy                # Kilowatt-hours
+        self.energy_low = energy
+        self.energy_high = energy
+        self.max_gap = max_gap              # Seconds
+        self.gaps = 0
+        self.last_time = None
+        self.last_power = None
+        self.last_sequence = None
+
+    @property
+    def error(self):
+        """Half width of the energy bounds in kilowatt-hours."""
+        return 0.5 * (self.energy_high - self.energy_low)
+
+    def update(self, power, sequence_number, timestamp):
+        """Add a power reading in kilowatts taken at a monotonic timestamp in seconds.
+
+        Returns False if the advertisement is a repeat of the previous one.
+        """
+        if sequence_number == self.last_sequence:
+            return False
+        self.last_sequence = sequence_number
+        if self.last_time is not None:
+            time_delta = timestamp - self.last_time
+            if time_delta > 0:
+                min_power = min(power, self.last_power)
+                max_power = max(power, self.last_power)
+                gap = 0.0
+                if time_delta > self.max_gap:
+                    self.gaps += 1
+                    gap = (time_delta - self.max_gap) / 3600.0 # Hours
+                    time_delta = self.max_gap
+                time_delta /= 3600.0 # Hours
+                self.energy += 0.5 * time_delta * (min_power + max_power)
+                self.energy_low += time_delta * min_power
+                self.energy_high += (time_delta + gap) * max_power
+        self.last_time = timestamp
+        self.last_power = power
+        return True
@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import time
+
+from bleak.exc import BleakError
+
+from switchbot_decoder import SwitchbotDeviceType
+
+UUID_REQUEST = "cba20002-224d-11e6-9fb8-0002a5d5c51b"
+UUID_RESPONSE = "cba20003-224d-11e6-9fb8-0002a5d5c51b"
+
+PLUG_MINI_COMMANDS = {
+    "on": bytes.fromhex("570f50010180"),
+    "off": bytes.fromhex("570f50010100"),
+    "toggle": bytes.fromhex("570f50010280"),
+    "state": bytes.fromhex("570f5101"),
+}
+
+METER_COMMANDS = {
+    "read": bytes.fromhex("570f31"), # Read Display Mode and Value of Meter
+}
+
+RESPONSE_OK = 0x01
+
+
+class CommandError(Exception):
+    pass
+
+
+def decode_plug_mini_response(response):
+    if len(response) < 2 or response[0] != RESPONSE_OK:
+        raise CommandError(f"Plug Mini responded {response.hex()}")
+    return { "enabled": response[1] == 0x80 }
+
+
+def decode_meter_response(response):
+    # Temperature and humidity use the same layout as the advertised service data
+    if len(response) < 4 or response[0] != RESPONSE_OK:
+        raise CommandError(f"Meter responded {response.hex()}")
+    temperature = (response[2] & 0x7F) + (response[1] & 0x0F) * 0.1
+    if not response[2] & 0x80:
+        temperature = -temperature
+    return { "temperature": temperature, "humidity": response[3] & 0x7F }
+
+
+# Device type -> (command name -> request, response decoder)
+SWITCHBOT_COMMANDS = {
+    SwitchbotDeviceType.PLUG_MINI: (PLUG_MINI_COMMANDS, decode_plug_mini_response),
+    SwitchbotDeviceType.METER: (METER_COMMANDS, decode_meter_response),
+    SwitchbotDeviceType.METER_PLUS: (METER_COMMANDS, decode_meter_response),
+}
+
+
+class GattConnection:
+    """A connected client and the request waiting for its response.
+
+    Requests on a connection are serialized by GattPool, so the next
+    notification on UUID_RESPONSE always answers the pending future.
+    """
+    __slots__ = ("client", "future", "last_used")
+
+    def __init__(self, client):
+        self.client = client
+        self.future = None
+        self.last_used = time.monotonic()
+
+    def notify(self, characteristic, data):
+        if self.future is not None and not self.future.done():
+            self.future.set_result(bytes(data))
+
+    async def request(self, packet, timeout):
+        self.future = asyncio.get_running_loop().create_future()
+        try:
+            await self.client.write_gatt_char(UUID_REQUEST, packet, response=True)
+            return await asyncio.wait_for(self.future, timeout)
+        finally:
+            self.future = None
+            self.last_used = time.monotonic()
+
+
+class GattPool:
+    """Bounded set of GATT connections shared by all commands.
+
+    client_factory(address) returns an unconnected BleakClient, or anything
+    with the same connect/disconnect/start_notify/write_gatt_char methods.
+    Commands for one device run one at a time. When size connections are
+    open the least recently used idle one is closed to make room, and
+    evict_idle() closes connections unused for idle_timeout seconds.
+    """
+
+    def __init__(self, client_factory, size=3, idle_timeout=30.0, timeout=10.0):
+        self.client_factory = client_factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connections = collections.OrderedDict()
+        self.locks = { }
+
+    async def command(self, address, packet):
+        """Send packet to a device and return its response, raising CommandError on failure."""
+        lock = self.locks.get(address)
+        if lock is None:
+            lock = self.locks[address] = asyncio.Lock()
+        async with lock:
+            try:
+                connection = await self.connect(address)
+                return await connection.request(packet, self.timeout)
+            except (BleakError, asyncio.TimeoutError, OSError) as e:
+                await self.disconnect(address)
+                raise CommandError(f"{type(e).__name__}: {e}" if str(e) != "" else type(e).__name__) from e
+
+    async def connect(self, address):
+        connection = self.connections.get(address)
+        if connection is not None:
+            if connection.client.is_connected:
+                self.connections.move_to_end(address)
+                return connection
+            await self.disconnect(address)
+        while len(self.connections) >= self.size:
+            idle = next((other for other in self.connections if not self.locks[other].locked()), None)
+            if idle is None:
+                # Every connection is in use, wait for one to finish
+                await asyncio.sleep(0.1)
+            else:
+                await self.disconnect(idle)
+        connection = GattConnection(self.client_factory(address))
+        # Reserve the slot before connecting so concurrent commands respect size,
+        # and free it again whatever way connecting fails, cancellation included
+        self.connections[address] = connection
+        try:
+            await asyncio.wait_for(connection.client.connect(), self.timeout)
+            await connection.client.start_notify(UUID_RESPONSE, connection.notify)
+        except BaseException:
+            await self.disconnect(address)
+            raise
+        return connection
+
+    async def disconnect(self, address):
+        connection = self.connections.pop(address, None)
+        if connection is not None:
+            try:
+                await connection.client.disconnect()
+            except (BleakError, asyncio.TimeoutError, OSError):
+                pass
+
+    async def evict_idle(self):
+        now = time.monotonic()
+        for address, connection in list(self.connections.items()):
+            if now - connection.last_used >= self.idle_timeout and not self.locks[address].locked():
+                await self.disconnect(address)
+
+    async def close(self):
+        for address in list(self.connections):
+            await self.disconnect(address)
+
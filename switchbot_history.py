@@ -0,0 +1,134 @@
+import math
+import mmap
+import os
+import struct
+
+HISTORY_FIELDS = ("temperature", "humidity", "power", "rssi", "battery")
+
+# Resolution name -> bucket length in seconds, 0 keeps every sample
+HISTORY_RESOLUTIONS = { "raw": 0, "1m": 60, "15m": 900 }
+
+# [magic][head][count] followed by the timestamp column (f64) and one f32 column per field
+RING_HEADER = struct.Struct("<8sqq")
+RING_MAGIC = b"SBRING01"
+
+
+class HistoryRing:
+    """Fixed capacity ring of samples stored column-wise in a memory map.
+
+    With a path the map is backed by that file, so samples survive restarts
+    and are paged out by the kernel instead of held in memory; without one an
+    anonymous map is used. The file is closed once mapped, the map keeps its
+    own descriptor. Missing values are stored as NaN.
+    """
+
+    def __init__(self, capacity, fields=len(HISTORY_FIELDS), path=None):
+        self.capacity = capacity
+        self.fields = fields
+        size = RING_HEADER.size + capacity * 8 + capacity * fields * 4
+        self.path = path
+        if path is None:
+            self.map = mmap.mmap(-1, size)
+        else:
+            with open(path, "a+b") as f:
+                if os.fstat(f.fileno()).st_size != size:
+                    f.truncate(0)
+                    f.truncate(size)
+                self.map = mmap.mmap(f.fileno(), size)
+        magic, self.head, self.count = RING_HEADER.unpack_from(self.map)
+        if magic != RING_MAGIC:
+            self.head = 0
+            self.count = 0
+            RING_HEADER.pack_into(self.map, 0, RING_MAGIC, 0, 0)
+        offset = RING_HEADER.size
+        self.timestamps = memoryview(self.map)[offset:offset + capacity * 8].cast("d")
+        offset += capacity * 8
+        self.values = memoryview(self.map)[offset:offset + capacity * fields * 4].cast("f")
+
+    def append(self, timestamp, values):
+        index = self.head
+        self.timestamps[index] = timestamp
+        base = index * self.fields
+        for field, value in enumerate(values):
+            self.values[base + field] = value
+        self.head = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, self.head, self.count)
+
+    def query(self, since=0.0, until=math.inf):
+        """Return [(timestamp, (values...)), ...] oldest first within [since, until].
+
+        Samples are appended in time order, so the first one is found by
+        bisecting instead of scanning the whole ring.
+        """
+        start = (self.head - self.count) % self.capacity
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[(start + middle) % self.capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        samples = []
+        for position in range(low, self.count):
+            index = (start + position) % self.capacity
+            timestamp = self.timestamps[index]
+            if timestamp > until:
+                break
+            base = index * self.fields
+            samples.append((timestamp, tuple(self.values[base:base + self.fields])))
+        return samples
+
+    def flush(self):
+        if self.path is not None:
+            self.map.flush()
+
+    def close(self):
+        self.timestamps.release()
+        self.values.release()
+        self.map.close()
+
+
+class DeviceHistory:
+    """Raw samples of one device plus 1 minute and 15 minute averages."""
+
+    def __init__(self, capacities, directory=None, name=None):
+        self.rings = { }
+        for resolution, capacity in capacities.items():
+            path = None if directory is None else os.path.join(directory, f"{name}_{resolution}.ring")
+            self.rings[resolution] = HistoryRing(capacity, len(HISTORY_FIELDS), path)
+        # Resolution -> [bucket start, sums per field, counts per field] of the bucket being averaged
+        self.buckets = { resolution: None for resolution in self.rings if HISTORY_RESOLUTIONS[resolution] > 0 }
+
+    def add(self, timestamp, values):
+        self.rings["raw"].append(timestamp, values)
+        for resolution, bucket in self.buckets.items():
+            length = HISTORY_RESOLUTIONS[resolution]
+            start = timestamp - timestamp % length
+            if bucket is not None and bucket[0] != start:
+                averages = [ total / count if count > 0 else math.nan for total, count in zip(bucket[1], bucket[2]) ]
+                self.rings[resolution].append(bucket[0], averages)
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[resolution] = [start, [0.0] * len(values), [0] * len(values)]
+            for field, value in enumerate(values):
+                if not math.isnan(value):
+                    bucket[1][field] += value
+                    bucket[2][field] += 1
+
+    def query(self, resolution="raw", since=0.0, until=math.inf):
+        return self.rings[resolution].query(since, until)
+
+    def flush(self):
+        for ring in self.rings.values():
+            ring.flush()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+
+
+def history_samples_json(samples):
+    """Convert query() results to JSON friendly [timestamp, {field: value}] pairs, leaving out missing values."""
+    return [ [ timestamp, { field: round(value, 4) for field, value in zip(HISTORY_FIELDS, values) if not math.isnan(value) } ] for timestamp, values in samples ]
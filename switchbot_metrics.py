@@ -0,0 +1,126 @@
+import asyncio
+import bisect
+import math
+
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+METRICS = []
+
+
+def format_labels(labelnames, labels):
+    if len(labelnames) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, labels)) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by a tuple of label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = { }
+        METRICS.append(self)
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+    def snapshot(self):
+        if len(self.labelnames) == 0:
+            return self.values.get((), 0)
+        return { ",".join(str(label) for label in labels): value for labels, value in self.values.items() }
+
+
+class Gauge:
+    """Value read from a function whenever the metrics are collected.
+
+    metric_type can be set to "counter" for totals that are kept elsewhere.
+    """
+
+    def __init__(self, name, documentation, function, metric_type="gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.metric_type = metric_type
+        METRICS.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}", f"{self.name} {self.function()}"]
+
+    def snapshot(self):
+        return self.function()
+
+
+class Histogram:
+    """Distribution of observed values, in seconds for latencies."""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        METRICS.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def snapshot(self):
+        return { "count": self.count, "sum": self.sum }
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_metrics():
+    return { metric.name: metric.snapshot() for metric in METRICS }
+
+
+async def serve_metrics(host, port):
+    """Serve render_metrics() over HTTP at /metrics."""
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            tokens = request.split(b" ")
+            if len(tokens) > 1 and tokens[1] in (b"/metrics", b"/"):
+                status = "200 OK"
+                body = render_metrics().encode()
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,96 @@
+import json
+import os
+
+
+class PersistenceStore:
+    """Crash-safe key/value store for values that must survive restarts.
+
+    The snapshot at path is only ever replaced atomically by writing a
+    temporary file and renaming it over the old one. Between snapshots,
+    flush() appends the keys changed since the previous flush as one JSON line
+    to path + ".journal". load() replays the journal over the snapshot and
+    discards a trailing line that was cut off by a crash. Once the journal
+    holds journal_limit lines it is compacted into a new snapshot.
+    """
+
+    def __init__(self, path, journal_limit=100):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.journal_limit = journal_limit
+        self.journal_lines = 0
+        self.data = { }
+        self.dirty = set()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def load(self):
+        self.data = { }
+        self.dirty = set()
+        self.journal_lines = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.data = json.load(f)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r+b") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Incomplete journal line")
+                        entries = json.loads(line)
+                    except ValueError:
+                        # Drop the torn write so later appends start on a fresh line
+                        f.truncate(offset)
+                        break
+                    self.data.update(entries)
+                    self.journal_lines += 1
+                    offset += len(line)
+        return self.data
+
+    def update(self, key, field, value):
+        if key not in self.data:
+            self.data[key] = { }
+        self.data[key][field] = value
+        self.dirty.add(key)
+
+    def write_journal(self):
+        if len(self.dirty) == 0:
+            return
+        entries = { key: self.data[key] for key in self.dirty if key in self.data }
+        with open(self.journal_path, "a") as f:
+            f.write(json.dumps(entries) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.dirty.clear()
+        self.journal_lines += 1
+
+    def flush(self):
+        """Append dirty keys to the journal, compacting it when it grows past journal_limit."""
+        self.write_journal()
+        if self.journal_lines >= self.journal_limit:
+            self.compact()
+
+    def compact(self):
+        """Atomically write all data as a new snapshot and start an empty journal."""
+        # Journal the dirty keys first so the last journal entry of every key
+        # matches the snapshot; a crash before the journal is removed then
+        # replays to the same state.
+        self.write_journal()
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_lines = 0
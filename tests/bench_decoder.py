@@ -0,0 +1,68 @@
+import importlib.util
+import timeit
+
+import pytest
+
+from switchbot_decoder import PlugMiniAdvertisement, SwitchbotDeviceType, ThermohydroAdvertisement, advertisement_device_type, decode_advertisement
+
+HAS_BENCHMARK = importlib.util.find_spec("pytest_benchmark") is not None
+
+# (service data, manufacturer data, expected decode) built by hand following the
+# documented layouts, with a placeholder MAC, rather than captured from devices
+SAMPLE_ADVERTISEMENTS = [
+    (bytes.fromhex("540064059f2d"), None,
+     (SwitchbotDeviceType.METER, { "battery": 100, "temperature": 31.5, "humidity": 45 })),
+    (bytes.fromhex("540064030732"), None,
+     (SwitchbotDeviceType.METER, { "battery": 100, "temperature": -7.3, "humidity": 50 })),
+    (bytes.fromhex("690064081437"), None,
+     (SwitchbotDeviceType.METER_PLUS, { "battery": 100, "temperature": -20.8, "humidity": 55 })),
+    (bytes.fromhex("77005a"), bytes.fromhex("aabbccddeeff010003853c00"),
+     (SwitchbotDeviceType.IO_THERMOHYDRO, { "battery": 90, "temperature": 5.3, "humidity": 60 })),
+    (bytes.fromhex("670000"), bytes.fromhex("aabbccddeeff2a80003003e8"),
+     (SwitchbotDeviceType.PLUG_MINI, { "sequence_number": 42, "enabled": True, "overload": False, "power": 0.1 })),
+]
+
+SAMPLE_IDS = [ f"{expected[0].name}-{index}" for index, (_, _, expected) in enumerate(SAMPLE_ADVERTISEMENTS) ]
+
+
+@pytest.mark.parametrize("service_data, manufacturer_data, expected", SAMPLE_ADVERTISEMENTS, ids=SAMPLE_IDS)
+def test_decode(service_data, manufacturer_data, expected):
+    device_type, fields = expected
+    assert advertisement_device_type(service_data) == device_type
+    advertisement = decode_advertisement(service_data, manufacturer_data)
+    assert advertisement.device_type == device_type
+    if device_type == SwitchbotDeviceType.PLUG_MINI:
+        assert isinstance(advertisement, PlugMiniAdvertisement)
+    else:
+        assert isinstance(advertisement, ThermohydroAdvertisement)
+    for field, value in fields.items():
+        assert getattr(advertisement, field) == pytest.approx(value), field
+
+
+@pytest.mark.parametrize("service_data, manufacturer_data", [
+    (b"", None),
+    (bytes.fromhex("5400"), None),
+    (bytes.fromhex("77005a"), None),
+    (bytes.fromhex("670000"), bytes.fromhex("aabbcc")),
+    (bytes.fromhex("480000"), None),
+])
+def test_decode_rejects_truncated_and_unsupported(service_data, manufacturer_data):
+    assert decode_advertisement(service_data, manufacturer_data) is None
+
+
+if not HAS_BENCHMARK:
+    @pytest.fixture
+    def benchmark(request):
+        """Fallback for the pytest-benchmark fixture, timing with timeit and printing the rate."""
+        def run(function, *args, **kwargs):
+            number = 100000
+            elapsed = timeit.timeit(lambda: function(*args, **kwargs), number=number)
+            print(f"{request.node.callspec.id}: {number / elapsed:,.0f} decodes/s")
+            return function(*args, **kwargs)
+        return run
+
+
+@pytest.mark.parametrize("service_data, manufacturer_data, expected", SAMPLE_ADVERTISEMENTS, ids=SAMPLE_IDS)
+def test_decode_rate(benchmark, service_data, manufacturer_data, expected):
+    advertisement = benchmark(decode_advertisement, service_data, manufacturer_data)
+    assert advertisement.device_type == expected[0]
@@ -0,0 +1,69 @@
+import collections
+import importlib
+import os
+
+import pytest
+
+TEST_CONFIG = """
+[meter]
+Kitchen = AA:BB:CC:DD:EE:01
+
+[io_thermohydro]
+Outside = AA:BB:CC:DD:EE:02
+
+[plug_mini]
+Desk = AA:BB:CC:DD:EE:03
+
+[mqtt]
+enabled = True
+publish_period = 1
+host = 127.0.0.1
+port = 1883
+username =
+password =
+topic_prefix = switchbot
+queue_size = 100
+reconnect_max = 1
+
+[homeassistant]
+send_config = True
+
+[persistence]
+enabled = False
+save_period = 60
+path = {directory}/persistence.json
+
+[unknown_devices]
+path = {directory}/enrolled.json
+
+[reload]
+watch_period = 0
+"""
+
+
+@pytest.fixture(scope="session")
+def switchbot_module(tmp_path_factory):
+    """switchbot.py imported against a test config.ini instead of the installation's."""
+    directory = tmp_path_factory.mktemp("switchbot")
+    config_path = directory / "config.ini"
+    config_path.write_text(TEST_CONFIG.format(directory=directory))
+    os.environ["SWITCHBOT_CONFIG"] = str(config_path)
+    return importlib.import_module("switchbot")
+
+
+@pytest.fixture
+def switchbot(switchbot_module, monkeypatch):
+    """switchbot.py with the device registry rebuilt and runtime state reset for each test."""
+    module = switchbot_module
+    for state in (module.SWITCHBOT_DEVICES, module.SWITCHBOT_OBJECT_IDS, module.SWITCHBOT_DATA, module.SWITCHBOT_PUBLISHED, module.SWITCHBOT_ENERGY,
+                  module.SWITCHBOT_AVAILABILITY, module.SCANNER_SEEN, module.SCANNER_NODE_TIMES, module.HOMEASSISTANT_DISCOVERY):
+        state.clear()
+    module.PIPELINE_QUEUE.clear()
+    module.AVAILABILITY_HEAP.clear()
+    monkeypatch.setattr(module, "SWITCHBOT_PERSISTENCE", module.PersistenceStore(module.PERSISTENCE_PATH, module.PERSISTENCE_JOURNAL_LIMIT))
+    module.config_load_devices(module.config)
+    for record in module.device_registry_build().values():
+        module.device_register(record)
+    monkeypatch.setattr(module, "MQTT_CLIENT", None)
+    monkeypatch.setattr(module, "MQTT_PENDING", collections.deque(maxlen=module.MQTT_QUEUE_SIZE))
+    return module
@@ -0,0 +1,190 @@
+import asyncio
+import struct
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def topic_matches(pattern, topic):
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | (0x80 if length > 0 else 0))
+        if length == 0:
+            return bytes(encoded)
+
+
+def read_string(body, offset):
+    length, = struct.unpack_from(">H", body, offset)
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+class StandInSession:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.will = None
+        self.subscriptions = []
+
+    def send(self, packet_type, flags, body):
+        if not self.writer.is_closing():
+            self.writer.write(bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body)
+
+
+class StandInBroker:
+    """Minimal in-process MQTT 3.1.1 broker for tests.
+
+    Supports QoS 0 and 1 publishes, retained messages, subscriptions with
+    wildcards and last will messages. Every publish it receives is recorded in
+    published as (topic, payload, retain) for assertions. A non-zero refuse
+    is sent as the CONNACK return code and the connection closed, as a broker
+    rejecting the credentials would.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, refuse=0):
+        self.host = host
+        self.port = port
+        self.refuse = refuse
+        self.attempts = 0
+        self.server = None
+        self.sessions = set()
+        self.retained = { }
+        self.published = []
+        self.connected = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop listening and drop every client connection as a network failure would."""
+        self.server.close()
+        for session in list(self.sessions):
+            session.writer.transport.abort()
+        await self.server.wait_closed()
+        while len(self.sessions) > 0:
+            await asyncio.sleep(0.01)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def wait_for(self, predicate, timeout=10.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not predicate():
+            if asyncio.get_running_loop().time() > deadline:
+                raise AssertionError("Timed out waiting for the broker")
+            await asyncio.sleep(0.01)
+
+    def route(self, topic, payload, retain):
+        self.published.append((topic, payload, retain))
+        if retain:
+            if payload == b"":
+                self.retained.pop(topic, None)
+            else:
+                self.retained[topic] = payload
+        body = struct.pack(">H", len(topic.encode())) + topic.encode() + payload
+        for session in list(self.sessions):
+            if any(topic_matches(pattern, topic) for pattern in session.subscriptions):
+                session.send(PUBLISH, 0, body)
+
+    async def handle(self, reader, writer):
+        session = StandInSession(writer)
+        self.sessions.add(session)
+        clean = False
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = header[0] >> 4
+                flags = header[0] & 0x0F
+                if packet_type == CONNECT:
+                    self.attempts += 1
+                    if self.refuse != 0:
+                        session.send(2, 0, bytes([0, self.refuse]))
+                        await writer.drain()
+                        clean = True
+                        break
+                    self.connect(session, body)
+                elif packet_type == PUBLISH:
+                    self.publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self.subscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(13, 0, b"")
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            if not clean and session.will is not None:
+                self.route(*session.will)
+            writer.close()
+
+    def connect(self, session, body):
+        protocol, offset = read_string(body, 0)
+        connect_flags = body[offset + 1]
+        offset += 4 # Level, flags and keepalive
+        client_id, offset = read_string(body, offset)
+        session.client_id = client_id.decode()
+        if connect_flags & 0x04:
+            will_topic, offset = read_string(body, offset)
+            will_payload, offset = read_string(body, offset)
+            session.will = (will_topic.decode(), will_payload, bool(connect_flags & 0x20))
+        session.send(2, 0, b"\x00\x00")
+        self.connected.set()
+
+    def publish(self, session, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic, offset = read_string(body, 0)
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.send(PUBACK, 0, packet_id)
+        self.route(topic.decode(), body[offset:], bool(flags & 0x01))
+
+    def subscribe(self, session, body):
+        packet_id = body[0:2]
+        offset = 2
+        granted = bytearray()
+        patterns = []
+        while offset < len(body):
+            pattern, offset = read_string(body, offset)
+            offset += 1 # Requested QoS
+            patterns.append(pattern.decode())
+            granted.append(0)
+        session.subscriptions.extend(patterns)
+        session.send(9, 0, packet_id + bytes(granted))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                session.send(PUBLISH, 0x01, struct.pack(">H", len(topic.encode())) + topic.encode() + payload)
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+METER = "AA:BB:CC:DD:EE:01"
+
+
+@pytest.fixture
+def clock(switchbot, monkeypatch):
+    """Controllable time.monotonic() for availability deadlines."""
+    now = [0.0]
+    monkeypatch.setattr(switchbot.time, "monotonic", lambda: now[0])
+    return now
+
+
+def heard(switchbot, clock, at):
+    clock[0] = at
+    record = switchbot.SWITCHBOT_DEVICES[METER]
+    switchbot.availability_heard(record, at, switchbot.SWITCHBOT_DATA.setdefault(METER, { }))
+
+
+def test_coming_back_online_publishes_the_new_reading(switchbot):
+    switchbot.advertisement_callback((1000.0, 1000.0, METER, -60, bytes.fromhex("540064059f2d"), None))
+    switchbot.SWITCHBOT_PUBLISHED[METER] = { "time": 1000.0, "data": dict(switchbot.SWITCHBOT_DATA[METER]) }
+    switchbot.availability_expire(float("inf"))
+    assert json.loads(switchbot.MQTT_PENDING[-1][1])["available"] == "offline"
+
+    switchbot.advertisement_callback((2000.0, 2000.0, METER, -60, bytes.fromhex("540064030732"), None))
+    topic, payload, retain = switchbot.MQTT_PENDING[-1]
+    assert topic == "switchbot/meter_kitchen/data"
+    published = json.loads(payload)
+    assert published["available"] == "online"
+    assert published["temperature"] == pytest.approx(-7.3)
+    assert published["last_advertisement"] == 2000.0
+
+
+def test_later_deadlines_are_rescheduled_lazily(switchbot, clock):
+    heard(switchbot, clock, 0.0)
+    assert [ entry[0] for entry in switchbot.AVAILABILITY_HEAP ] == [switchbot.availability_timeout(None)]
+
+    # A learned interval gives an earlier deadline, which replaces the entry
+    heard(switchbot, clock, 1.0)
+    entry = switchbot.SWITCHBOT_AVAILABILITY[METER]
+    assert entry["interval"] == 1.0
+    assert entry["scheduled"] == 1.0 + switchbot.availability_timeout(1.0)
+    assert len(switchbot.AVAILABILITY_HEAP) == 2
+
+    # A later deadline only updates the device, the heap is left alone
+    heard(switchbot, clock, 20.0)
+    assert entry["deadline"] == 20.0 + switchbot.availability_timeout(entry["interval"])
+    assert len(switchbot.AVAILABILITY_HEAP) == 2
+
+    # The entry coming due is pushed back to the device's current deadline
+    switchbot.availability_expire(entry["scheduled"])
+    assert switchbot.SWITCHBOT_DATA[METER]["available"] == "online"
+    assert entry["scheduled"] == entry["deadline"]
+    assert switchbot.AVAILABILITY_HEAP[0][0] == entry["deadline"]
+
+    switchbot.availability_expire(entry["deadline"])
+    assert switchbot.SWITCHBOT_DATA[METER]["available"] == "offline"
+
+    # The replaced entry is discarded without touching the device again
+    switchbot.SWITCHBOT_DATA[METER]["available"] = "online"
+    switchbot.availability_expire(float("inf"))
+    assert switchbot.SWITCHBOT_DATA[METER]["available"] == "online"
+    assert len(switchbot.AVAILABILITY_HEAP) == 0
+
+
+def test_intervals_across_a_scanning_pause_are_not_learned(switchbot, clock, monkeypatch):
+    heard(switchbot, clock, 100.0)
+    heard(switchbot, clock, 102.0)
+    entry = switchbot.SWITCHBOT_AVAILABILITY[METER]
+    assert entry["interval"] == 2.0
+
+    monkeypatch.setattr(switchbot, "SCANNER_RESUMED", 150.0)
+    heard(switchbot, clock, 160.0)
+    assert entry["interval"] == 2.0
+    assert entry["last"] == 160.0
+
+    heard(switchbot, clock, 162.0)
+    assert entry["interval"] == 2.0
+    heard(switchbot, clock, 172.0)
+    assert entry["interval"] == pytest.approx(2.0 + switchbot.AVAILABILITY_SMOOTHING * 8.0)
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from switchbot_capture import CapturedAdvertisement, CaptureWriter, address_to_bytes, read_capture
+from switchbot_decoder import MANUFACTURER_ID, UUID_BROADCAST, SwitchbotDeviceType, decode_advertisement
+
+PLUG = "AA:BB:CC:DD:EE:03"
+RECORDED = 1600000000.0
+
+
+def plug_advertisement(timestamp, sequence_number, tenths_of_watt):
+    manufacturer_data = address_to_bytes(PLUG) + bytes([sequence_number & 0xFF, 0x80, 0x00, 0x00, tenths_of_watt >> 8, tenths_of_watt & 0xFF])
+    service_data = bytes([SwitchbotDeviceType.PLUG_MINI.value, 0x00, 0x00])
+    return CapturedAdvertisement(timestamp, PLUG, -60, { UUID_BROADCAST: service_data }, { MANUFACTURER_ID: manufacturer_data })
+
+
+def write_capture(path, advertisements):
+    writer = CaptureWriter(path)
+    for advertisement in advertisements:
+        writer.write(advertisement, advertisement, advertisement.timestamp)
+    writer.close()
+
+
+def test_capture_round_trip(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    advertisements = [ plug_advertisement(RECORDED + second, second, 10000) for second in range(3) ]
+    write_capture(path, advertisements)
+    replayed = list(read_capture(path))
+    assert [ advertisement.timestamp for advertisement in replayed ] == [ advertisement.timestamp for advertisement in advertisements ]
+    assert replayed[1].manufacturer_data == advertisements[1].manufacturer_data
+
+
+def test_replay_keeps_recorded_timestamps(switchbot, monkeypatch, tmp_path):
+    # Ten minutes of a constant 1 kW load recorded once a second, replayed as fast as possible
+    path = str(tmp_path / "capture.bin")
+    advertisements = [ plug_advertisement(RECORDED + second, second, 10000) for second in range(601) ]
+    write_capture(path, advertisements)
+    monkeypatch.setattr(switchbot, "CAPTURE_REPLAY_PATH", path)
+    monkeypatch.setattr(switchbot, "CAPTURE_REPLAY_SPEED", 0.0)
+
+    async def replay():
+        task = asyncio.ensure_future(switchbot.switchbot_sample())
+        while len(switchbot.PIPELINE_QUEUE) < len(advertisements):
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(replay())
+    frames = list(switchbot.PIPELINE_QUEUE)
+    assert [ frame[1] for frame in frames ] == [ advertisement.timestamp for advertisement in advertisements ]
+    for frame in frames:
+        switchbot.advertisement_aggregate(frame)
+
+    power = decode_advertisement(frames[0][4], frames[0][5]).power
+    data = switchbot.SWITCHBOT_DATA[PLUG]
+    assert data["energy"] == pytest.approx(power * 600 / 3600)
+    assert data["last_advertisement"] == RECORDED + 600
+    assert switchbot.SWITCHBOT_AVAILABILITY[PLUG]["interval"] == pytest.approx(1.0)
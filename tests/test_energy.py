@@ -0,0 +1,71 @@
+import math
+import random
+
+import pytest
+
+from switchbot_energy import EnergyIntegrator
+
+
+def integrate(trace, integrator=None):
+    """Feed (timestamp, power) pairs with increasing sequence numbers."""
+    integrator = EnergyIntegrator() if integrator is None else integrator
+    for sequence_number, (timestamp, power) in enumerate(trace):
+        integrator.update(power, sequence_number % 256, timestamp)
+    return integrator
+
+
+def test_constant_power():
+    integrator = integrate([ (float(second), 1.5) for second in range(3601) ])
+    assert integrator.energy == pytest.approx(1.5)
+    assert integrator.energy_low == pytest.approx(1.5)
+    assert integrator.energy_high == pytest.approx(1.5)
+    assert integrator.error == pytest.approx(0.0)
+    assert integrator.gaps == 0
+
+
+def test_ramp_matches_analytic_integral():
+    # Power rising linearly from 0 to 2 kW over an hour integrates to 1 kWh
+    duration = 3600.0
+    integrator = integrate([ (float(second), 2.0 * second / duration) for second in range(3601) ])
+    assert integrator.energy == pytest.approx(1.0)
+    assert integrator.energy_low < 1.0 < integrator.energy_high
+    assert integrator.error == pytest.approx(2.0 / duration / 2.0)
+
+
+def test_duplicate_sequence_numbers_are_ignored():
+    integrator = EnergyIntegrator()
+    assert integrator.update(1.0, 7, 0.0)
+    assert not integrator.update(5.0, 7, 1.0)
+    assert not integrator.update(5.0, 7, 2.0)
+    assert integrator.update(1.0, 8, 3600.0 / 60)
+    assert integrator.energy == pytest.approx(1.0 / 60)
+    assert integrator.last_power == 1.0
+
+
+def test_gap_longer_than_max_gap():
+    integrator = EnergyIntegrator(max_gap=60.0)
+    integrator.update(1.0, 0, 0.0)
+    integrator.update(2.0, 1, 600.0)
+    assert integrator.gaps == 1
+    # Only max_gap is integrated; the rest of the gap is bounded by 0 and the larger reading
+    assert integrator.energy == pytest.approx(60.0 / 3600 * 1.5)
+    assert integrator.energy_low == pytest.approx(60.0 / 3600 * 1.0)
+    assert integrator.energy_high == pytest.approx(600.0 / 3600 * 2.0)
+
+
+def test_starting_energy_is_kept():
+    integrator = integrate([ (0.0, 1.0), (3600.0, 1.0) ], EnergyIntegrator(energy=10.0, max_gap=math.inf))
+    assert integrator.energy == pytest.approx(11.0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bounds_contain_energy(seed):
+    generator = random.Random(seed)
+    integrator = EnergyIntegrator(max_gap=30.0)
+    timestamp = 0.0
+    for sequence_number in range(2000):
+        timestamp += generator.choice([0.5, 1.0, 2.0, 45.0, 120.0])
+        repeat = generator.random() < 0.1
+        integrator.update(generator.uniform(0.0, 3.0), (sequence_number - repeat) % 256, timestamp)
+        assert integrator.energy_low - 1e-12 <= integrator.energy <= integrator.energy_high + 1e-12
+    assert integrator.gaps > 0
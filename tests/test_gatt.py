@@ -0,0 +1,212 @@
+import asyncio
+
+import pytest
+from bleak.exc import BleakError
+
+from switchbot_decoder import SwitchbotDeviceType
+from switchbot_gatt import (METER_COMMANDS, PLUG_MINI_COMMANDS, RESPONSE_OK, CommandError, GattPool,
+                            decode_meter_response, decode_plug_mini_response)
+
+
+class FakeGattClient:
+    """Stand-in for BleakClient answering like a Plug Mini or Meter.
+
+    reply_delay None never answers, connect_error is raised from connect().
+    Every client made is kept in clients, and the writes in flight per address
+    are tracked to check that commands for one device are serialized.
+    """
+
+    clients = []
+    in_flight = { }
+
+    def __init__(self, address, device_type=SwitchbotDeviceType.PLUG_MINI, delay=0.01, reply_delay=0.01, connect_error=None):
+        self.address = address
+        self.device_type = device_type
+        self.delay = delay
+        self.reply_delay = reply_delay
+        self.connect_error = connect_error
+        self.is_connected = False
+        self.enabled = False
+        self.callback = None
+        self.disconnects = 0
+        self.written = []
+        FakeGattClient.clients.append(self)
+
+    async def connect(self):
+        await asyncio.sleep(self.delay)
+        if self.connect_error is not None:
+            raise self.connect_error
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.disconnects += 1
+
+    async def start_notify(self, uuid, callback):
+        self.callback = callback
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        if not self.is_connected:
+            raise BleakError("Not connected")
+        data = bytes(data)
+        self.written.append(data)
+        if data == PLUG_MINI_COMMANDS["on"] or data == PLUG_MINI_COMMANDS["off"]:
+            self.enabled = data == PLUG_MINI_COMMANDS["on"]
+        elif data == PLUG_MINI_COMMANDS["toggle"]:
+            self.enabled = not self.enabled
+        if self.device_type == SwitchbotDeviceType.PLUG_MINI and data in PLUG_MINI_COMMANDS.values():
+            reply = bytes([RESPONSE_OK, 0x80 if self.enabled else 0x00])
+        elif self.device_type != SwitchbotDeviceType.PLUG_MINI and data == METER_COMMANDS["read"]:
+            reply = bytes([RESPONSE_OK, 0x05, 0x80 | 21, 48])
+        else:
+            reply = bytes([0x05]) # Unsupported command
+        if self.reply_delay is not None:
+            in_flight = FakeGattClient.in_flight
+            in_flight[self.address] = in_flight.get(self.address, 0) + 1
+            assert in_flight[self.address] == 1, f"Overlapping commands for {self.address}"
+            asyncio.get_running_loop().call_later(self.reply_delay, self.reply, bytearray(reply))
+
+    def reply(self, reply):
+        FakeGattClient.in_flight[self.address] -= 1
+        self.callback(None, reply)
+
+
+@pytest.fixture(autouse=True)
+def fake_clients():
+    FakeGattClient.clients.clear()
+    FakeGattClient.in_flight.clear()
+    yield FakeGattClient.clients
+
+
+def client_for(clients, address):
+    return [client for client in clients if client.address == address][-1]
+
+
+def test_commands_for_one_device_are_serialized():
+    async def scenario():
+        pool = GattPool(FakeGattClient, size=2)
+        packets = [PLUG_MINI_COMMANDS["on"], PLUG_MINI_COMMANDS["toggle"], PLUG_MINI_COMMANDS["toggle"], PLUG_MINI_COMMANDS["state"]]
+        responses = await asyncio.gather(*[pool.command("AA", packet) for packet in packets])
+        assert [decode_plug_mini_response(response)["enabled"] for response in responses] == [True, False, True, True]
+        assert len(FakeGattClient.clients) == 1
+        assert FakeGattClient.clients[0].written == packets
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_responses_are_matched_to_their_device():
+    def factory(address):
+        device_type = SwitchbotDeviceType.METER if address == "METER" else SwitchbotDeviceType.PLUG_MINI
+        return FakeGattClient(address, device_type, reply_delay=0.05 if address == "METER" else 0.01)
+
+    async def scenario():
+        pool = GattPool(factory, size=2)
+        meter, plug = await asyncio.gather(pool.command("METER", METER_COMMANDS["read"]), pool.command("PLUG", PLUG_MINI_COMMANDS["on"]))
+        assert decode_meter_response(meter) == { "temperature": pytest.approx(21.5), "humidity": 48 }
+        assert decode_plug_mini_response(plug) == { "enabled": True }
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_notification_without_pending_request_is_ignored():
+    async def scenario():
+        pool = GattPool(FakeGattClient)
+        await pool.command("AA", PLUG_MINI_COMMANDS["on"])
+        connection = pool.connections["AA"]
+        connection.notify(None, bytearray([RESPONSE_OK, 0x00]))
+        response = await pool.command("AA", PLUG_MINI_COMMANDS["state"])
+        assert decode_plug_mini_response(response) == { "enabled": True }
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_least_recently_used_idle_connection_is_evicted():
+    async def scenario():
+        pool = GattPool(FakeGattClient, size=2)
+        await pool.command("AA", PLUG_MINI_COMMANDS["state"])
+        await pool.command("BB", PLUG_MINI_COMMANDS["state"])
+        await pool.command("AA", PLUG_MINI_COMMANDS["state"])
+        await pool.command("CC", PLUG_MINI_COMMANDS["state"])
+        assert list(pool.connections) == ["AA", "CC"]
+        assert client_for(FakeGattClient.clients, "BB").disconnects == 1
+        assert client_for(FakeGattClient.clients, "AA").disconnects == 0
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_busy_connections_are_not_evicted():
+    async def scenario():
+        pool = GattPool(lambda address: FakeGattClient(address, reply_delay=0.2 if address == "AA" else 0.01), size=1)
+        slow = asyncio.ensure_future(pool.command("AA", PLUG_MINI_COMMANDS["on"]))
+        await asyncio.sleep(0.05)
+        # AA is waiting for its response, BB has to wait for it instead of evicting it
+        await pool.command("BB", PLUG_MINI_COMMANDS["state"])
+        assert decode_plug_mini_response(await slow) == { "enabled": True }
+        assert list(pool.connections) == ["BB"]
+        assert len(pool.connections) <= pool.size
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_idle_connections_are_closed():
+    async def scenario():
+        pool = GattPool(FakeGattClient, size=2, idle_timeout=0.05)
+        await pool.command("AA", PLUG_MINI_COMMANDS["state"])
+        await asyncio.sleep(0.03)
+        await pool.command("BB", PLUG_MINI_COMMANDS["state"])
+        await asyncio.sleep(0.03)
+        await pool.evict_idle()
+        assert list(pool.connections) == ["BB"]
+        await asyncio.sleep(0.03)
+        await pool.evict_idle()
+        assert len(pool.connections) == 0
+        assert all(client.disconnects == 1 for client in FakeGattClient.clients)
+
+    asyncio.run(scenario())
+
+
+def test_timeout_disconnects():
+    async def scenario():
+        pool = GattPool(lambda address: FakeGattClient(address, reply_delay=None), timeout=0.05)
+        with pytest.raises(CommandError, match="TimeoutError"):
+            await pool.command("AA", PLUG_MINI_COMMANDS["on"])
+        assert len(pool.connections) == 0
+        assert FakeGattClient.clients[0].disconnects == 1
+        assert not FakeGattClient.clients[0].is_connected
+
+    asyncio.run(scenario())
+
+
+def test_failed_connect_frees_the_reserved_slot():
+    def factory(address):
+        return FakeGattClient(address, connect_error=BleakError("Device not found") if address == "GONE" else None)
+
+    async def scenario():
+        pool = GattPool(factory, size=1)
+        with pytest.raises(CommandError, match="Device not found"):
+            await pool.command("GONE", PLUG_MINI_COMMANDS["on"])
+        assert len(pool.connections) == 0
+        response = await asyncio.wait_for(pool.command("AA", PLUG_MINI_COMMANDS["on"]), 1.0)
+        assert decode_plug_mini_response(response) == { "enabled": True }
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_connect_frees_the_reserved_slot():
+    async def scenario():
+        pool = GattPool(lambda address: FakeGattClient(address, delay=1.0), size=1)
+        task = asyncio.ensure_future(pool.command("AA", PLUG_MINI_COMMANDS["on"]))
+        await asyncio.sleep(0.01)
+        assert list(pool.connections) == ["AA"]
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert len(pool.connections) == 0
+
+    asyncio.run(scenario())
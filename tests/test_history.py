@@ -0,0 +1,64 @@
+import math
+import os
+
+import pytest
+
+from switchbot_history import DeviceHistory, HistoryRing, history_samples_json
+
+CAPACITIES = { "raw": 100, "1m": 10, "15m": 5 }
+START = 1700000040.0 # Start of a minute
+
+
+def open_descriptors():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def test_ring_wraps_and_queries_in_order():
+    ring = HistoryRing(4, 1)
+    for second in range(6):
+        ring.append(START + second, [float(second)])
+    assert [ values[0] for timestamp, values in ring.query() ] == [2.0, 3.0, 4.0, 5.0]
+    assert [ timestamp - START for timestamp, values in ring.query(START + 3, START + 4) ] == [3.0, 4.0]
+    assert ring.query(START + 10) == []
+
+
+def test_averages_per_minute():
+    history = DeviceHistory(CAPACITIES)
+    for second in range(0, 180, 2):
+        history.add(START + second, [float(second // 60), 50.0, math.nan, -60.0, 100.0])
+    minutes = history.query("1m")
+    # The third minute is still being averaged
+    assert [ timestamp - START for timestamp, values in minutes ] == [0.0, 60.0]
+    assert [ values[0] for timestamp, values in minutes ] == [0.0, 1.0]
+    assert math.isnan(minutes[0][1][2])
+    assert history_samples_json(minutes[:1]) == [[START, { "temperature": 0.0, "humidity": 50.0, "rssi": -60.0, "battery": 100.0 }]]
+
+
+def test_file_backed_history_survives_reopen(tmp_path):
+    history = DeviceHistory(CAPACITIES, str(tmp_path), "METER-AA_BB")
+    history.add(START, [21.5, 40.0, math.nan, -70.0, 90.0])
+    history.flush()
+    history.close()
+    reopened = DeviceHistory(CAPACITIES, str(tmp_path), "METER-AA_BB")
+    assert reopened.query("raw") == [(START, (21.5, 40.0, pytest.approx(math.nan, nan_ok=True), -70.0, 90.0))]
+    reopened.close()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_file_backed_rings_hold_one_descriptor_each(tmp_path):
+    before = open_descriptors()
+    histories = [ DeviceHistory(CAPACITIES, str(tmp_path), f"PLUG_MINI-{index}") for index in range(20) ]
+    assert open_descriptors() - before <= 20 * len(CAPACITIES)
+    for history in histories:
+        history.close()
+    assert open_descriptors() == before
+
+
+def test_history_record_falls_back_to_memory(switchbot, monkeypatch, tmp_path):
+    monkeypatch.setattr(switchbot, "HISTORY_PATH", str(tmp_path / "missing"))
+    monkeypatch.setattr(switchbot, "SWITCHBOT_HISTORY", { })
+    record = switchbot.SWITCHBOT_DEVICES["AA:BB:CC:DD:EE:01"]
+    switchbot.history_record(record, START, { "temperature": 20.0, "rssi": -50 })
+    history = switchbot.SWITCHBOT_HISTORY[record.address]
+    assert all(ring.path is None for ring in history.rings.values())
+    assert history.query("raw")[0][1][0] == 20.0
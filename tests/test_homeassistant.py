@@ -0,0 +1,62 @@
+import asyncio
+
+METER = "AA:BB:CC:DD:EE:01"
+PLUG = "AA:BB:CC:DD:EE:03"
+
+
+def discovery_sent(switchbot):
+    return [ (topic, payload) for topic, payload, retain in switchbot.MQTT_PENDING if topic.startswith("homeassistant/") ]
+
+
+def test_discovery_is_sent_once_across_publish_cycles(switchbot, monkeypatch):
+    monkeypatch.setattr(switchbot, "MQTT_PUBLISH_PERIOD", 0.01)
+    switchbot.SWITCHBOT_DATA[METER] = { "rssi": -60, "battery": 100, "temperature": 21.0, "humidity": 40, "available": "online", "last_advertisement": 1000.0 }
+    record = switchbot.SWITCHBOT_DEVICES[METER]
+
+    async def scenario():
+        task = asyncio.ensure_future(switchbot.mqtt_publish())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(scenario())
+    sent = discovery_sent(switchbot)
+    assert sorted(topic for topic, payload in sent) == sorted(topic for field, topic in record.discovery_topics)
+    assert all(retain for topic, payload, retain in switchbot.MQTT_PENDING if topic.startswith("homeassistant/"))
+
+
+def test_discovery_is_resent_only_when_the_record_changes(switchbot):
+    record = switchbot.SWITCHBOT_DEVICES[METER]
+    switchbot.homeassistant_announce(record)
+    first = len(discovery_sent(switchbot))
+    switchbot.homeassistant_announce(switchbot.make_device_record(METER, record.device_type, record.name))
+    assert len(discovery_sent(switchbot)) == first
+
+    renamed = switchbot.make_device_record(METER, record.device_type, "Pantry")
+    switchbot.homeassistant_announce(renamed)
+    sent = discovery_sent(switchbot)[first:]
+    assert set(topic for topic, payload in sent if payload != "") == set(topic for field, topic in renamed.discovery_topics)
+    assert set(topic for topic, payload in sent if payload == "") == set(topic for field, topic in record.discovery_topics)
+
+
+def test_topics_dropping_out_are_cleared(switchbot):
+    record = switchbot.SWITCHBOT_DEVICES[PLUG]
+    switchbot.homeassistant_announce(record)
+    first = len(discovery_sent(switchbot))
+
+    # A record with one field fewer keeps the other topics and clears the dropped one
+    dropped_topic = record.discovery_topics[-1][1]
+    reduced = record._replace(discovery_topics=record.discovery_topics[:-1])
+    switchbot.homeassistant_announce(reduced)
+    sent = discovery_sent(switchbot)[first:]
+    assert [ topic for topic, payload in sent if payload == "" ] == [dropped_topic]
+    announced = set(topic for topic, payload in discovery_sent(switchbot)[:first])
+    assert set(topic for topic, payload in sent if payload != "") == announced - { dropped_topic }
+
+    # Retracting clears everything that is still announced
+    switchbot.homeassistant_retract(PLUG)
+    cleared = [ topic for topic, payload in discovery_sent(switchbot)[first + len(sent):] if payload == "" ]
+    assert set(cleared) == set(topic for topic, payload in sent if payload != "")
@@ -0,0 +1,107 @@
+import asyncio
+import collections
+
+from mqtt_broker import StandInBroker
+
+
+async def stop_task(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def test_connect_publishes_online_status_and_will(switchbot, monkeypatch):
+    async def scenario():
+        async with StandInBroker() as broker:
+            monkeypatch.setattr(switchbot, "MQTT_PORT", broker.port)
+            loop_task = asyncio.ensure_future(switchbot.mqtt_loop())
+            await broker.wait_for(lambda: broker.retained.get("switchbot/status") == b"online")
+            session = next(iter(broker.sessions))
+            assert session.will == ("switchbot/status", b"offline", True)
+            switchbot.mqtt_send("switchbot/test", "hello")
+            await broker.wait_for(lambda: ("switchbot/test", b"hello", False) in broker.published)
+            await stop_task(loop_task)
+            switchbot.MQTT_CLIENT.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_drop_queues_and_flushes_on_reconnect(switchbot, monkeypatch):
+    monkeypatch.setattr(switchbot, "MQTT_PENDING", collections.deque(maxlen=3))
+
+    async def scenario():
+        broker = StandInBroker()
+        await broker.start()
+        port = broker.port
+        monkeypatch.setattr(switchbot, "MQTT_PORT", port)
+        loop_task = asyncio.ensure_future(switchbot.mqtt_loop())
+        await broker.wait_for(lambda: switchbot.MQTT_CLIENT is not None and switchbot.MQTT_CLIENT.is_connected())
+
+        # Connection lost: the broker publishes the will
+        await broker.stop()
+        assert broker.retained["switchbot/status"] == b"offline"
+        await broker.wait_for(lambda: not switchbot.MQTT_CLIENT.is_connected())
+
+        # Offline messages are queued, the oldest dropped beyond the limit
+        for index in range(5):
+            switchbot.mqtt_send("switchbot/queued", str(index))
+        assert [payload for topic, payload, retain in switchbot.MQTT_PENDING] == ["2", "3", "4"]
+
+        # Reconnect with backoff and flush the queue in order
+        restarted = StandInBroker(port=port)
+        restarted.retained = broker.retained
+        await restarted.start()
+        await restarted.wait_for(lambda: restarted.retained.get("switchbot/status") == b"online")
+        await restarted.wait_for(lambda: len([p for t, p, r in restarted.published if t == "switchbot/queued"]) == 3)
+        assert [payload for topic, payload, retain in restarted.published if topic == "switchbot/queued"] == [b"2", b"3", b"4"]
+        assert len(switchbot.MQTT_PENDING) == 0
+
+        await stop_task(loop_task)
+        switchbot.MQTT_CLIENT.disconnect()
+        await restarted.stop()
+
+    asyncio.run(scenario())
+
+
+def test_send_before_first_connect_is_queued(switchbot):
+    switchbot.mqtt_send("switchbot/early", "1", retain=True)
+    assert list(switchbot.MQTT_PENDING) == [("switchbot/early", "1", True)]
+
+
+def test_refused_connection_backs_off_until_accepted(switchbot, monkeypatch):
+    monkeypatch.setattr(switchbot, "MQTT_RECONNECT_MAX", 4.0)
+    sleeps = []
+    real_sleep = asyncio.sleep
+
+    async def fast_sleep(delay, *args, **kwargs):
+        # Record the requested delays but wait a fraction of them
+        sleeps.append(delay)
+        return await real_sleep(delay / 20, *args, **kwargs)
+    monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+
+    async def scenario():
+        broker = StandInBroker(refuse=5) # Not authorized
+        await broker.start()
+        monkeypatch.setattr(switchbot, "MQTT_PORT", broker.port)
+        loop_task = asyncio.ensure_future(switchbot.mqtt_loop())
+        await broker.wait_for(lambda: broker.attempts >= 4)
+        assert [ delay for delay in sleeps if delay >= 2 ][:2] == [2.0, 4.0]
+        assert "switchbot/status" not in broker.retained
+
+        # Once accepted the backoff starts over, a dropped connection is retried after a second
+        broker.refuse = 0
+        await broker.wait_for(lambda: broker.retained.get("switchbot/status") == b"online")
+        await broker.stop()
+        dropped = len(sleeps)
+        restarted = StandInBroker(port=broker.port)
+        await restarted.start()
+        await restarted.wait_for(lambda: restarted.retained.get("switchbot/status") == b"online")
+        assert max(sleeps[dropped:]) == 1.0
+
+        await stop_task(loop_task)
+        switchbot.MQTT_CLIENT.disconnect()
+        await restarted.stop()
+
+    asyncio.run(scenario())
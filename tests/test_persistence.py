@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+
+from switchbot_persistence import PersistenceStore
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def crash(*args, **kwargs):
+    raise SimulatedCrash()
+
+
+def journal_entries(store):
+    with open(store.journal_path, "r") as f:
+        return [ json.loads(line) for line in f ]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "persistence.json")
+
+
+def test_flush_journals_only_dirty_keys(path):
+    store = PersistenceStore(path)
+    store.update("PLUG_MINI-A", "energy", 1.0)
+    store.update("PLUG_MINI-B", "energy", 2.0)
+    store.flush()
+    store.update("PLUG_MINI-B", "energy", 2.5)
+    store.flush()
+    store.flush()
+    assert journal_entries(store) == [
+        { "PLUG_MINI-A": { "energy": 1.0 }, "PLUG_MINI-B": { "energy": 2.0 } },
+        { "PLUG_MINI-B": { "energy": 2.5 } },
+    ]
+    assert PersistenceStore(path).load() == { "PLUG_MINI-A": { "energy": 1.0 }, "PLUG_MINI-B": { "energy": 2.5 } }
+
+
+def test_torn_final_journal_line_is_discarded(path):
+    store = PersistenceStore(path)
+    store.update("PLUG_MINI-A", "energy", 1.0)
+    store.flush()
+    with open(store.journal_path, "a") as f:
+        f.write('{"PLUG_MINI-A": {"ener')
+
+    recovered = PersistenceStore(path)
+    assert recovered.load() == { "PLUG_MINI-A": { "energy": 1.0 } }
+    # Appends after recovery must start on a fresh line
+    recovered.update("PLUG_MINI-A", "energy", 3.0)
+    recovered.flush()
+    assert PersistenceStore(path).load() == { "PLUG_MINI-A": { "energy": 3.0 } }
+
+
+def test_crash_before_snapshot_rename(path, monkeypatch):
+    store = PersistenceStore(path)
+    store.update("PLUG_MINI-A", "energy", 1.0)
+    store.compact()
+    store.update("PLUG_MINI-A", "energy", 2.0)
+    store.update("PLUG_MINI-B", "energy", 5.0)
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(SimulatedCrash):
+        store.compact()
+    monkeypatch.undo()
+
+    assert os.path.exists(path + ".tmp")
+    with open(path, "r") as f:
+        assert json.load(f) == { "PLUG_MINI-A": { "energy": 1.0 } }
+    recovered = PersistenceStore(path)
+    assert recovered.load() == { "PLUG_MINI-A": { "energy": 2.0 }, "PLUG_MINI-B": { "energy": 5.0 } }
+    recovered.compact()
+    assert not os.path.exists(recovered.journal_path)
+    assert PersistenceStore(path).load() == { "PLUG_MINI-A": { "energy": 2.0 }, "PLUG_MINI-B": { "energy": 5.0 } }
+
+
+def test_crash_before_journal_removal(path, monkeypatch):
+    store = PersistenceStore(path)
+    store.update("PLUG_MINI-A", "energy", 1.0)
+    store.flush()
+    store.update("PLUG_MINI-A", "energy", 2.0)
+    monkeypatch.setattr(os, "remove", crash)
+    with pytest.raises(SimulatedCrash):
+        store.compact()
+    monkeypatch.undo()
+
+    assert os.path.exists(store.journal_path)
+    recovered = PersistenceStore(path)
+    assert recovered.load() == { "PLUG_MINI-A": { "energy": 2.0 } }
+    recovered.update("PLUG_MINI-A", "energy", 4.0)
+    recovered.compact()
+    assert PersistenceStore(path).load() == { "PLUG_MINI-A": { "energy": 4.0 } }
+
+
+def test_legacy_snapshot_loads(path):
+    # Format written by the whole-file save_persistence() before the journal existed
+    with open(path, "w") as f:
+        json.dump({ "PLUG_MINI-AA:BB:CC:DD:EE:FF": { "energy": 12.5 } }, f)
+
+    store = PersistenceStore(path)
+    assert store.load() == { "PLUG_MINI-AA:BB:CC:DD:EE:FF": { "energy": 12.5 } }
+    assert store.journal_lines == 0
+    store.update("PLUG_MINI-AA:BB:CC:DD:EE:FF", "energy", 13.0)
+    store.flush()
+    assert PersistenceStore(path).load() == { "PLUG_MINI-AA:BB:CC:DD:EE:FF": { "energy": 13.0 } }
+
+
+def test_journal_compacts_at_limit(path):
+    store = PersistenceStore(path, journal_limit=3)
+    for value in range(3):
+        store.update("PLUG_MINI-A", "energy", float(value))
+        store.flush()
+    assert not os.path.exists(store.journal_path)
+    assert store.journal_lines == 0
+    with open(path, "r") as f:
+        assert json.load(f) == { "PLUG_MINI-A": { "energy": 2.0 } }
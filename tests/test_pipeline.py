@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from switchbot_capture import CapturedAdvertisement, address_to_bytes, encode_advertisement
+from switchbot_decoder import MANUFACTURER_ID, UUID_BROADCAST
+
+METER = "AA:BB:CC:DD:EE:01"
+PLUG = "AA:BB:CC:DD:EE:03"
+METER_SERVICE_DATA = bytes.fromhex("690064081437")
+PLUG_SERVICE_DATA = bytes.fromhex("670000")
+
+
+def plug_manufacturer_data(sequence_number, tenths_of_watt):
+    return address_to_bytes(PLUG) + bytes([sequence_number & 0xFF, 0x80, 0x00, 0x00, tenths_of_watt >> 8, tenths_of_watt & 0xFF])
+
+
+def advertisement(address, service_data, manufacturer_data=None):
+    return CapturedAdvertisement(time.time(), address, -60, { UUID_BROADCAST: service_data }, manufacturer_data or { })
+
+
+def test_empty_service_data_is_not_queued(switchbot):
+    captured = advertisement(METER, b"")
+    switchbot.advertisement_enqueue(captured, captured)
+    assert len(switchbot.PIPELINE_QUEUE) == 0
+
+
+def test_empty_forwarded_service_data_is_not_queued(switchbot):
+    payload = encode_advertisement(time.time(), METER, -60, { UUID_BROADCAST: b"" }, { }) + encode_advertisement(time.time(), METER, -60, { UUID_BROADCAST: METER_SERVICE_DATA }, { })
+    switchbot.advertisement_receive(payload, "shed")
+    assert [ frame[4] for frame in switchbot.PIPELINE_QUEUE ] == [METER_SERVICE_DATA]
+
+
+def test_coalesce_keeps_latest_meter_and_every_plug(switchbot):
+    plug_service_data = bytes.fromhex("670000")
+    frames = [
+        (0.0, 0.0, METER, -60, METER_SERVICE_DATA, None),
+        (0.1, 0.1, PLUG, -60, plug_service_data, b"1"),
+        (0.2, 0.2, METER, -55, METER_SERVICE_DATA, None),
+        (0.3, 0.3, PLUG, -60, plug_service_data, b"2"),
+    ]
+    assert switchbot.advertisement_coalesce(frames) == [frames[1], frames[3], frames[2]]
+
+
+def test_copies_from_two_adapters_are_counted_once(switchbot):
+    # Ten minutes of a constant 1 kW load heard once a second by a near and a far adapter
+    for second in range(601):
+        manufacturer_data = plug_manufacturer_data(second, 10000)
+        near = (1000.0 + second, 1000.0 + second, PLUG, -50, PLUG_SERVICE_DATA, manufacturer_data)
+        far = (1000.01 + second, 1000.01 + second, PLUG, -80, PLUG_SERVICE_DATA, manufacturer_data)
+        frames = [near, far] if second % 2 == 0 else [far, near]
+        for frame in switchbot.advertisement_coalesce(frames):
+            switchbot.advertisement_aggregate(frame)
+    assert switchbot.SWITCHBOT_DATA[PLUG]["energy"] == pytest.approx(1.0 * 600 / 3600)
+    assert switchbot.SWITCHBOT_DATA[PLUG]["rssi"] == -50
+
+
+def test_forwarded_advertisements_keep_node_spacing(switchbot, monkeypatch):
+    node_time = 1600000000.0
+    def batch(first, count):
+        return b"".join(encode_advertisement(node_time + second, PLUG, -60, { UUID_BROADCAST: PLUG_SERVICE_DATA }, { MANUFACTURER_ID: plug_manufacturer_data(second, 10000) })
+                        for second in range(first, first + count))
+
+    # The newest advertisement of a batch is taken to arrive without delay
+    monkeypatch.setattr(switchbot.time, "monotonic", lambda: 500.0)
+    switchbot.advertisement_receive(batch(0, 3), "shed")
+    assert [ frame[0] for frame in switchbot.PIPELINE_QUEUE ] == [498.0, 499.0, 500.0]
+    assert [ frame[1] for frame in switchbot.PIPELINE_QUEUE ] == [node_time, node_time + 1, node_time + 2]
+
+    # A batch arriving quicker than the previous one does not move source time backwards
+    switchbot.PIPELINE_QUEUE.clear()
+    monkeypatch.setattr(switchbot.time, "monotonic", lambda: 501.5)
+    switchbot.advertisement_receive(batch(3, 3), "shed")
+    assert [ frame[0] for frame in switchbot.PIPELINE_QUEUE ] == [500.0, 500.5, 501.5]
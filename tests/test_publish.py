@@ -0,0 +1,44 @@
+import copy
+
+
+def test_homeassistant_birth_republishes_state(switchbot):
+    address = "AA:BB:CC:DD:EE:01"
+    record = switchbot.SWITCHBOT_DEVICES[address]
+    data = { "rssi": -60, "battery": 100, "temperature": 21.0, "humidity": 40, "available": "online", "last_advertisement": 1000.0 }
+    switchbot.SWITCHBOT_PUBLISHED[address] = { "time": 1000.0, "data": dict(data) }
+    assert not switchbot.publish_due(address, record.device_type, data, 1001.0)
+
+    switchbot.homeassistant_announce_all()
+    assert switchbot.publish_due(address, record.device_type, data, 1001.0)
+
+
+def test_deadband_and_heartbeat(switchbot):
+    address = "AA:BB:CC:DD:EE:01"
+    device_type = switchbot.SWITCHBOT_DEVICES[address].device_type
+    policy = switchbot.SWITCHBOT_PUBLISH_POLICY[device_type]
+    data = { "temperature": 21.0, "available": "online", "last_advertisement": 0.0 }
+    switchbot.SWITCHBOT_PUBLISHED[address] = { "time": 0.0, "data": dict(data) }
+    after = policy["min_interval"]
+    assert not switchbot.publish_due(address, device_type, dict(data, temperature=21.0 + policy["deadband"]["temperature"] / 2), after)
+    assert switchbot.publish_due(address, device_type, dict(data, temperature=21.0 + policy["deadband"]["temperature"]), after)
+    assert switchbot.publish_due(address, device_type, dict(data, available="offline"), after)
+    assert switchbot.publish_due(address, device_type, data, policy["max_interval"])
+
+
+def test_meter_overrides_apply_to_meter_plus(switchbot):
+    policies = copy.deepcopy(switchbot.SWITCHBOT_PUBLISH_POLICY)
+    switchbot.publish_policy_override(policies, { "meter_temperature": "0.5", "meter_max_interval": "600", "meter_plus_humidity": "3", "plug_mini_power": "0.01" })
+    meter = policies[switchbot.SwitchbotDeviceType.METER]
+    meter_plus = policies[switchbot.SwitchbotDeviceType.METER_PLUS]
+    assert meter["deadband"]["temperature"] == meter_plus["deadband"]["temperature"] == 0.5
+    assert meter["max_interval"] == meter_plus["max_interval"] == 600
+    assert meter_plus["deadband"]["humidity"] == 3
+    assert meter["deadband"]["humidity"] == switchbot.SWITCHBOT_PUBLISH_POLICY[switchbot.SwitchbotDeviceType.METER]["deadband"]["humidity"]
+    assert policies[switchbot.SwitchbotDeviceType.PLUG_MINI]["deadband"]["power"] == 0.01
+
+
+def test_meter_plus_overrides_take_precedence(switchbot):
+    policies = copy.deepcopy(switchbot.SWITCHBOT_PUBLISH_POLICY)
+    switchbot.publish_policy_override(policies, { "meter_plus_temperature": "0.3", "meter_temperature": "0.5" })
+    assert policies[switchbot.SwitchbotDeviceType.METER]["deadband"]["temperature"] == 0.5
+    assert policies[switchbot.SwitchbotDeviceType.METER_PLUS]["deadband"]["temperature"] == 0.3
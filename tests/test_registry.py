@@ -0,0 +1,35 @@
+from switchbot_decoder import SwitchbotDeviceType
+from switchbot_persistence import PersistenceStore
+
+
+def test_object_id_index_matches_devices(switchbot):
+    assert len(switchbot.SWITCHBOT_OBJECT_IDS) == len(switchbot.SWITCHBOT_DEVICES)
+    for record in switchbot.SWITCHBOT_DEVICES.values():
+        assert switchbot.device_by_object_id(record.object_id) is record
+    assert switchbot.device_by_object_id("meter_missing") is None
+
+
+def test_resolve_replaces_object_id(switchbot):
+    address = "AA:BB:CC:DD:EE:01"
+    previous = switchbot.SWITCHBOT_DEVICES[address].object_id
+    record = switchbot.device_registry_resolve(address, SwitchbotDeviceType.METER_PLUS)
+    assert switchbot.device_by_object_id(previous) is None
+    assert switchbot.device_by_object_id(record.object_id) is record
+    assert record.object_id == "meter_plus_kitchen"
+
+
+def test_remove_drops_object_id(switchbot):
+    record = switchbot.SWITCHBOT_DEVICES["AA:BB:CC:DD:EE:03"]
+    switchbot.device_remove(record.address)
+    assert switchbot.device_by_object_id(record.object_id) is None
+    assert len(switchbot.SWITCHBOT_OBJECT_IDS) == len(switchbot.SWITCHBOT_DEVICES)
+
+
+def test_enroll_indexes_object_id(switchbot, monkeypatch, tmp_path):
+    monkeypatch.setattr(switchbot, "UNKNOWN_ENROLLED", PersistenceStore(str(tmp_path / "enrolled.json")))
+    monkeypatch.setattr(switchbot, "PLUG_MINI_DEVICES", dict(switchbot.PLUG_MINI_DEVICES))
+    monkeypatch.setattr(switchbot, "DEVICE_TABLES", tuple((section, device_type, switchbot.PLUG_MINI_DEVICES if section == "plug_mini" else devices)
+                                                          for section, device_type, devices in switchbot.DEVICE_TABLES))
+    switchbot.device_enroll("AA:BB:CC:DD:EE:F0", SwitchbotDeviceType.PLUG_MINI)
+    record = switchbot.SWITCHBOT_DEVICES["AA:BB:CC:DD:EE:F0"]
+    assert switchbot.device_by_object_id(record.object_id) is record
@@ -0,0 +1,85 @@
+import pytest
+
+from switchbot_decoder import SwitchbotDeviceType
+
+METER_PLUS_FRAME = bytes.fromhex("690064081437")
+PLUG_FRAME = bytes.fromhex("670000")
+
+
+@pytest.fixture
+def config_file(switchbot, monkeypatch, tmp_path):
+    """Write an edited copy of the test config.ini for config_reload() to pick up."""
+    with open(switchbot.config_path) as f:
+        original = f.read()
+    path = tmp_path / "config.ini"
+    monkeypatch.setattr(switchbot, "config_path", str(path))
+
+    def edit(old, new):
+        path.write_text(original.replace(old, new))
+    return edit
+
+
+def retracted(switchbot, topics):
+    return [ topic for topic, payload, retain in switchbot.MQTT_PENDING if topic in topics and payload == "" and retain ]
+
+
+def test_added_device_is_registered(switchbot, config_file):
+    config_file("Kitchen = AA:BB:CC:DD:EE:01", "Kitchen = AA:BB:CC:DD:EE:01\nGarage = AA:BB:CC:DD:EE:04")
+    switchbot.config_reload()
+    record = switchbot.SWITCHBOT_DEVICES["AA:BB:CC:DD:EE:04"]
+    assert record.device_type == SwitchbotDeviceType.METER
+    assert switchbot.device_by_object_id("meter_garage") is record
+
+
+def test_removed_device_retracts_discovery(switchbot, config_file):
+    record = switchbot.SWITCHBOT_DEVICES["AA:BB:CC:DD:EE:03"]
+    switchbot.homeassistant_announce(record)
+    config_file("Desk = AA:BB:CC:DD:EE:03", "")
+    switchbot.config_reload()
+    assert record.address not in switchbot.SWITCHBOT_DEVICES
+    assert switchbot.device_by_object_id(record.object_id) is None
+    topics = set(topic for field, topic in record.discovery_topics)
+    assert set(retracted(switchbot, topics)) == topics
+
+
+def test_renamed_meter_plus_keeps_resolved_type(switchbot, config_file):
+    address = "AA:BB:CC:DD:EE:01"
+    switchbot.advertisement_callback((1000.0, 1000.0, address, -60, METER_PLUS_FRAME, None))
+    before = switchbot.SWITCHBOT_DEVICES[address]
+    assert before.device_type == SwitchbotDeviceType.METER_PLUS
+    switchbot.homeassistant_announce(before)
+
+    config_file("Kitchen = AA:BB:CC:DD:EE:01", "Pantry = AA:BB:CC:DD:EE:01")
+    switchbot.config_reload()
+    record = switchbot.SWITCHBOT_DEVICES[address]
+    assert record.device_type == SwitchbotDeviceType.METER_PLUS
+    assert record.object_id == "meter_plus_pantry"
+    assert switchbot.device_by_object_id(before.object_id) is None
+    assert address not in switchbot.SWITCHBOT_PUBLISHED
+
+    # The next announce clears the old discovery topics and publishes the new ones
+    switchbot.homeassistant_announce(record)
+    old_topics = set(topic for field, topic in before.discovery_topics)
+    assert set(retracted(switchbot, old_topics)) == old_topics
+    assert any(topic.startswith("homeassistant/sensor/switchbot_meter_plus_pantry/") and payload != "" for topic, payload, retain in switchbot.MQTT_PENDING)
+
+    # Advertisements carry on under the renamed record without resolving it again
+    switchbot.advertisement_callback((1001.0, 1001.0, address, -60, METER_PLUS_FRAME, None))
+    assert switchbot.SWITCHBOT_DEVICES[address] is record
+
+
+def test_untouched_devices_keep_state_and_energy(switchbot, config_file):
+    plug = "AA:BB:CC:DD:EE:03"
+    for sequence in range(3):
+        manufacturer_data = bytes.fromhex("aabbccddeeff") + bytes([sequence, 0x80, 0x00, 0x30]) + (1000).to_bytes(2, "big")
+        switchbot.advertisement_callback((1000.0 + sequence, 1000.0 + sequence, plug, -60, PLUG_FRAME, manufacturer_data))
+    data = dict(switchbot.SWITCHBOT_DATA[plug])
+    integrator = switchbot.SWITCHBOT_ENERGY[plug]
+    record = switchbot.SWITCHBOT_DEVICES[plug]
+    assert data["energy"] > 0
+
+    config_file("Kitchen = AA:BB:CC:DD:EE:01", "Pantry = AA:BB:CC:DD:EE:01")
+    switchbot.config_reload()
+    assert switchbot.SWITCHBOT_DEVICES[plug] is record
+    assert switchbot.SWITCHBOT_DATA[plug] == data
+    assert switchbot.SWITCHBOT_ENERGY[plug] is integrator